@@ -0,0 +1,220 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## This file is part of LDAPAlchemy
+## Copyright (C) 2007 Cleber Rodrigues <cleber.gnu@gmail.com>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rodrigues <cleber.gnu@gmail.com>
+##
+'''
+cache.py
+
+   Provides a cache for search results
+'''
+
+__all__ = ['ResultCache']
+
+import time
+import threading
+
+import ldap
+
+from ldapalchemy.util import normalize_dn, dn_ancestors
+
+#
+# Positions in the nodes of the LRU list
+#
+(PREV, NEXT, KEY, VALUE, EXPIRES) = range(5)
+
+class ResultCache:
+    '''
+    A cache of search results, with LRU eviction and TTL expiration
+
+    Results are keyed on (base, scope, filter, attributes, sort keys). The
+    cache is bounded both by the number of results (size) and by the total
+    number of entries in all results (max_entries). When any bound is
+    reached, the least recently used results are evicted.
+
+    Writes to the directory invalidate every cached result whose base and
+    scope cover the DN being written.
+
+    The hits, misses, evictions, expirations and invalidations counters
+    help sizing the cache.
+    '''
+    def __init__(self, size=1000, ttl=60, max_entries=None):
+        self.size = size
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        '''
+        Drops all cached results and resets the counters
+        '''
+        self._lock.acquire()
+        try:
+            self._nodes = {}
+            self._by_base = {}
+            self._entries = 0
+
+            #
+            # Circular doubly linked list, most recently used at the head
+            #
+            self._root = root = []
+            root[:] = [root, root, None, None, None]
+
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expirations = 0
+            self.invalidations = 0
+        finally:
+            self._lock.release()
+
+    def make_key(self, base, scope, filter_string, attrlist, sort=None):
+        if attrlist is not None:
+            attrlist = tuple(attrlist)
+        if sort is not None:
+            sort = tuple(sort)
+        return (normalize_dn(base), scope, filter_string, attrlist, sort)
+
+    def get(self, key):
+        '''
+        Returns the cached result for key, or None
+        '''
+        self._lock.acquire()
+        try:
+            node = self._nodes.get(key)
+            if node is None:
+                self.misses += 1
+                return None
+
+            if node[EXPIRES] < time.time():
+                self.__remove(node)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self.__unlink(node)
+            self.__link(node)
+            self.hits += 1
+            return node[VALUE]
+        finally:
+            self._lock.release()
+
+    def put(self, key, value, ttl=None):
+        '''
+        Caches value (a list of entries) under key for ttl seconds
+        '''
+        if ttl is None:
+            ttl = self.ttl
+
+        if self.max_entries is not None and len(value) > self.max_entries:
+            return
+
+        self._lock.acquire()
+        try:
+            node = self._nodes.get(key)
+            if node is not None:
+                self.__remove(node)
+
+            node = [None, None, key, value, time.time() + ttl]
+            self.__link(node)
+            self._nodes[key] = node
+            self._by_base.setdefault(key[0], {})[key] = True
+            self._entries += len(value)
+
+            while len(self._nodes) > self.size or \
+                    (self.max_entries is not None and
+                     self._entries > self.max_entries):
+                self.__remove(self._root[PREV])
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def invalidate(self, dn, subtree=False):
+        '''
+        Drops the cached results that might include the entry named dn
+
+        With subtree, results that might include any entry below dn are
+        dropped too
+        '''
+        ancestors = dn_ancestors(dn)
+        self._lock.acquire()
+        try:
+            if subtree:
+                suffix = ',' + ancestors[0]
+                for base in self._by_base.keys():
+                    if base.endswith(suffix):
+                        for key in self._by_base[base].keys():
+                            self.__remove(self._nodes[key])
+                            self.invalidations += 1
+            for depth, base in enumerate(ancestors):
+                keys = self._by_base.get(base)
+                if not keys:
+                    continue
+                for key in keys.keys():
+                    scope = key[1]
+                    if scope == ldap.SCOPE_SUBTREE or \
+                            (scope == ldap.SCOPE_ONELEVEL and depth == 1) or \
+                            (scope == ldap.SCOPE_BASE and depth == 0):
+                        self.__remove(self._nodes[key])
+                        self.invalidations += 1
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        '''
+        Returns a dict with the cache counters and current usage
+        '''
+        return {'hits' : self.hits,
+                'misses' : self.misses,
+                'evictions' : self.evictions,
+                'expirations' : self.expirations,
+                'invalidations' : self.invalidations,
+                'results' : len(self._nodes),
+                'entries' : self._entries}
+
+    #
+    # Internal Methods. These expect the lock to be held
+    #
+    def __link(self, node):
+        root = self._root
+        first = root[NEXT]
+        node[PREV] = root
+        node[NEXT] = first
+        first[PREV] = node
+        root[NEXT] = node
+
+    def __unlink(self, node):
+        node[PREV][NEXT] = node[NEXT]
+        node[NEXT][PREV] = node[PREV]
+
+    def __remove(self, node):
+        self.__unlink(node)
+        key = node[KEY]
+        del self._nodes[key]
+        keys = self._by_base[key[0]]
+        del keys[key]
+        if not keys:
+            del self._by_base[key[0]]
+        self._entries -= len(node[VALUE])
@@ -61,6 +61,13 @@ class Config:
         self.__connection_basedn = ""
         self.__connection_binddn = ""
         self.__connection_bindpw = ""
+
+        self.__search_indexed_attributes = ['uid', 'mail', 'uidNumber',
+                                             'gidNumber', 'memberUid',
+                                             'member', 'cn', 'sn',
+                                             'objectClass']
+
+        self.__schema_cache_size = 256
         
     def __get_compatibility_sqlalchemy_level(self):
         '''
@@ -128,6 +135,32 @@ class Config:
 
     connection_bindpw = property(__get_connection_bindpw)
 
+    def __get_search_indexed_attributes(self):
+        '''
+        Returns the attributes indexed by the LDAP server, most selective
+        first. Used for ordering the terms of search filters
+        '''
+        env_var = "LDAPALCHEMY_SEARCH_INDEXED_ATTRIBUTES"
+        if os.environ.has_key(env_var):
+            return [a.strip() for a in os.environ[env_var].split(',')]
+
+        return self.__search_indexed_attributes
+
+    search_indexed_attributes = property(__get_search_indexed_attributes)
+
+    def __get_schema_cache_size(self):
+        '''
+        Returns how many parsed schema elements a SchemaWeakCache keeps
+        alive on its own
+        '''
+        env_var = "LDAPALCHEMY_SCHEMA_CACHE_SIZE"
+        if os.environ.has_key(env_var):
+            return int(os.environ[env_var])
+
+        return self.__schema_cache_size
+
+    schema_cache_size = property(__get_schema_cache_size)
+
 
 class PersistentConfig(Config, ConfigParser):
     '''
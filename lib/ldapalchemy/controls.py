@@ -0,0 +1,434 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## This file is part of LDAPAlchemy
+## Copyright (C) 2007 Cleber Rodrigues <cleber.gnu@gmail.com>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rodrigues <cleber.gnu@gmail.com>
+##
+'''
+controls.py
+
+   Provides LDAP controls not available in the python ldap module
+
+   The control values are encoded with the minimal BER support found here,
+   so no extra ASN.1 module is required. The controls work with both the
+   controls API of python ldap 2.3 and the one of 2.4 and later.
+'''
+
+__all__ = ['SortRequestControl', 'SortResponseControl',
+           'VLVRequestControl', 'VLVResponseControl',
+           'SyncRequestControl', 'SyncStateControl', 'SyncDoneControl',
+           'TreeDeleteControl', 'PagedResultsControl',
+           'decode_sync_info',
+           'CONTROL_SORT_REQUEST', 'CONTROL_SORT_RESPONSE',
+           'CONTROL_VLV_REQUEST', 'CONTROL_VLV_RESPONSE',
+           'CONTROL_SYNC_REQUEST', 'CONTROL_SYNC_STATE', 'CONTROL_SYNC_DONE',
+           'CONTROL_TREE_DELETE', 'CONTROL_PAGED_RESULTS', 'SYNC_INFO_OID']
+
+import ldap.controls
+
+from ldap.controls import LDAPControl
+
+#
+# Control OIDs
+#
+CONTROL_SORT_REQUEST = '1.2.840.113556.1.4.473'         # RFC 2891
+CONTROL_SORT_RESPONSE = '1.2.840.113556.1.4.474'
+CONTROL_VLV_REQUEST = '2.16.840.1.113730.3.4.9'         # draft-ietf-ldapext-ldapv3-vlv
+CONTROL_VLV_RESPONSE = '2.16.840.1.113730.3.4.10'
+CONTROL_SYNC_REQUEST = '1.3.6.1.4.1.4203.1.9.1.1'      # RFC 4533
+CONTROL_SYNC_STATE = '1.3.6.1.4.1.4203.1.9.1.2'
+CONTROL_SYNC_DONE = '1.3.6.1.4.1.4203.1.9.1.3'
+SYNC_INFO_OID = '1.3.6.1.4.1.4203.1.9.1.4'
+CONTROL_TREE_DELETE = '1.2.840.113556.1.4.805'
+CONTROL_PAGED_RESULTS = '1.2.840.113556.1.4.319'      # RFC 2696
+
+#
+# Content synchronization modes and entry states
+#
+(SYNC_MODE_REFRESH_ONLY,
+ SYNC_MODE_REFRESH_AND_PERSIST) = (1, 3)
+
+(SYNC_STATE_PRESENT,
+ SYNC_STATE_ADD,
+ SYNC_STATE_MODIFY,
+ SYNC_STATE_DELETE) = range(4)
+
+#
+# BER tags
+#
+(TAG_BOOLEAN,
+ TAG_INTEGER,
+ TAG_OCTET_STRING,
+ TAG_ENUMERATED,
+ TAG_SEQUENCE) = (0x01, 0x02, 0x04, 0x0a, 0x30)
+
+#
+# Minimal BER encoding and decoding
+#
+def ber_length(length):
+    if length < 0x80:
+        return chr(length)
+    octets = ''
+    while length:
+        octets = chr(length & 0xff) + octets
+        length >>= 8
+    return chr(0x80 | len(octets)) + octets
+
+def ber_encode(tag, contents):
+    return chr(tag) + ber_length(len(contents)) + contents
+
+def ber_integer(value, tag=TAG_INTEGER):
+    octets = ''
+    while True:
+        octets = chr(value & 0xff) + octets
+        value >>= 8
+        if value in (0, -1) and \
+                (ord(octets[0]) & 0x80) == (value & 0x80):
+            break
+    return ber_encode(tag, octets)
+
+def ber_boolean(value, tag=TAG_BOOLEAN):
+    return ber_encode(tag, value and '\xff' or '\x00')
+
+def ber_sequence(*items, **kwargs):
+    return ber_encode(kwargs.get('tag', TAG_SEQUENCE), ''.join(items))
+
+def ber_decode(data):
+    '''
+    Decodes the first element of data
+
+    Returns (tag, contents, rest)
+    '''
+    tag = ord(data[0])
+    length = ord(data[1])
+    offset = 2
+    if length & 0x80:
+        count = length & 0x7f
+        length = 0
+        for c in data[2:2 + count]:
+            length = (length << 8) | ord(c)
+        offset += count
+    return tag, data[offset:offset + length], data[offset + length:]
+
+def ber_decode_integer(contents):
+    value = 0
+    for c in contents:
+        value = (value << 8) | ord(c)
+    if contents and ord(contents[0]) & 0x80:
+        value -= 1 << (8 * len(contents))
+    return value
+
+def ber_decode_sequence(contents):
+    '''
+    Returns the list of (tag, contents) elements in a sequence
+    '''
+    items = []
+    while contents:
+        tag, value, contents = ber_decode(contents)
+        items.append((tag, value))
+    return items
+
+#
+# Where the python ldap module looks up the classes of response controls
+#
+if hasattr(ldap.controls, 'KNOWN_RESPONSE_CONTROLS'):
+    KNOWN_RESPONSE_CONTROLS = ldap.controls.KNOWN_RESPONSE_CONTROLS
+else:
+    KNOWN_RESPONSE_CONTROLS = ldap.controls.knownLDAPControls
+
+class BaseRequestControl(LDAPControl):
+    '''
+    Base class for the request controls here
+
+    python ldap 2.3 calls encodeControlValue() with the control value,
+    2.4 with no arguments. Either way, encode() is given controlValue
+    '''
+    controlType = None
+
+    def __init__(self, criticality, controlValue=None, encodedControlValue=None):
+        self.controlType = self.__class__.controlType
+        self.criticality = criticality
+        self.controlValue = controlValue
+        self.encodedControlValue = encodedControlValue
+
+    def encodeControlValue(self, *args):
+        return self.encode(self.controlValue)
+
+    def encode(self, value):
+        return value
+
+class BaseResponseControl(LDAPControl):
+    '''
+    Base class for the response controls here
+
+    python ldap 2.3 creates response controls with the encoded value and
+    uses what decodeControlValue() returns. 2.4 creates them with no
+    arguments and then calls decodeControlValue(), ignoring what it
+    returns. Either way, controlValue is set to what decode() returns
+    '''
+    controlType = None
+
+    def __init__(self, controlType=None, criticality=False, controlValue=None,
+                 encodedControlValue=None):
+        self.controlType = controlType or self.__class__.controlType
+        self.criticality = criticality
+        self.controlValue = controlValue
+        if controlValue is None and encodedControlValue is not None:
+            self.decodeControlValue(encodedControlValue)
+
+    def decodeControlValue(self, encodedValue):
+        self.encodedControlValue = encodedValue
+        self.controlValue = self.decode(encodedValue)
+        return self.controlValue
+
+    def decode(self, encodedValue):
+        return encodedValue
+
+class SortRequestControl(BaseRequestControl):
+    '''
+    Server Side Sort request control, as defined in RFC 2891
+
+    controlValue is a list of sort keys. Each one is either an attribute
+    name, optionally prefixed with "-" for reverse order and suffixed with
+    ":<ordering rule OID>", or a (name, ordering_rule, reverse) tuple.
+    '''
+    controlType = CONTROL_SORT_REQUEST
+
+    def parse_key(self, key):
+        '''
+        Returns (name, ordering_rule, reverse) for the given sort key
+        '''
+        if type(key) == tuple:
+            return key
+        reverse = key.startswith('-')
+        if reverse:
+            key = key[1:]
+        ordering_rule = None
+        if ':' in key:
+            key, ordering_rule = key.split(':', 1)
+        return (key, ordering_rule, reverse)
+
+    def encode(self, value):
+        keys = []
+        for key in value:
+            name, ordering_rule, reverse = self.parse_key(key)
+            items = [ber_encode(TAG_OCTET_STRING, name)]
+            if ordering_rule:
+                items.append(ber_encode(0x80, ordering_rule))
+            if reverse:
+                items.append(ber_boolean(True, 0x81))
+            keys.append(ber_sequence(*items))
+        return ber_sequence(*keys)
+
+class SortResponseControl(BaseResponseControl):
+    '''
+    Server Side Sort response control, as defined in RFC 2891
+
+    controlValue is a (result_code, attribute_name) tuple
+    '''
+    controlType = CONTROL_SORT_RESPONSE
+
+    def decode(self, encodedValue):
+        tag, contents, rest = ber_decode(encodedValue)
+        items = ber_decode_sequence(contents)
+        result = ber_decode_integer(items[0][1])
+        attribute = None
+        if len(items) > 1:
+            attribute = items[1][1]
+        return (result, attribute)
+
+class VLVRequestControl(BaseRequestControl):
+    '''
+    Virtual List View request control
+
+    controlValue is a (before_count, after_count, offset, content_count,
+    context_id) tuple. offset is 1 based. A content_count of zero tells
+    the server that offset is an absolute position.
+    '''
+    controlType = CONTROL_VLV_REQUEST
+
+    def encode(self, value):
+        before_count, after_count, offset, content_count, context_id = value
+        items = [ber_integer(before_count),
+                 ber_integer(after_count),
+                 ber_sequence(ber_integer(offset), ber_integer(content_count),
+                              tag=0xa0)]
+        if context_id:
+            items.append(ber_encode(TAG_OCTET_STRING, context_id))
+        return ber_sequence(*items)
+
+class VLVResponseControl(BaseResponseControl):
+    '''
+    Virtual List View response control
+
+    controlValue is a (target_position, content_count, result_code,
+    context_id) tuple
+    '''
+    controlType = CONTROL_VLV_RESPONSE
+
+    def decode(self, encodedValue):
+        tag, contents, rest = ber_decode(encodedValue)
+        items = ber_decode_sequence(contents)
+        target_position = ber_decode_integer(items[0][1])
+        content_count = ber_decode_integer(items[1][1])
+        result = ber_decode_integer(items[2][1])
+        context_id = None
+        if len(items) > 3:
+            context_id = items[3][1]
+        return (target_position, content_count, result, context_id)
+
+class SyncRequestControl(BaseRequestControl):
+    '''
+    Content Synchronization request control, as defined in RFC 4533
+
+    controlValue is a (mode, cookie, reload_hint) tuple
+    '''
+    controlType = CONTROL_SYNC_REQUEST
+
+    def encode(self, value):
+        mode, cookie, reload_hint = value
+        items = [ber_integer(mode, TAG_ENUMERATED)]
+        if cookie:
+            items.append(ber_encode(TAG_OCTET_STRING, cookie))
+        if reload_hint:
+            items.append(ber_boolean(True))
+        return ber_sequence(*items)
+
+class SyncStateControl(BaseResponseControl):
+    '''
+    Content Synchronization state control, sent along with each entry
+
+    controlValue is a (state, entry_uuid, cookie) tuple
+    '''
+    controlType = CONTROL_SYNC_STATE
+
+    def decode(self, encodedValue):
+        tag, contents, rest = ber_decode(encodedValue)
+        items = ber_decode_sequence(contents)
+        state = ber_decode_integer(items[0][1])
+        entry_uuid = items[1][1]
+        cookie = None
+        if len(items) > 2:
+            cookie = items[2][1]
+        return (state, entry_uuid, cookie)
+
+class SyncDoneControl(BaseResponseControl):
+    '''
+    Content Synchronization done control, sent at the end of a refresh
+
+    controlValue is a (cookie, refresh_deletes) tuple
+    '''
+    controlType = CONTROL_SYNC_DONE
+
+    def decode(self, encodedValue):
+        tag, contents, rest = ber_decode(encodedValue)
+        cookie = None
+        refresh_deletes = False
+        for tag, value in ber_decode_sequence(contents):
+            if tag == TAG_OCTET_STRING:
+                cookie = value
+            elif tag == TAG_BOOLEAN:
+                refresh_deletes = ber_decode_integer(value) != 0
+        return (cookie, refresh_deletes)
+
+class TreeDeleteControl(BaseRequestControl):
+    '''
+    Tree Delete control: deletes a entry along with all entries below it
+
+    It has no value
+    '''
+    controlType = CONTROL_TREE_DELETE
+
+    def __init__(self, criticality=True, controlValue=None,
+                 encodedControlValue=None):
+        BaseRequestControl.__init__(self, criticality)
+
+class PagedResultsControl(BaseResponseControl):
+    '''
+    Simple Paged Results control, as defined in RFC 2696
+
+    controlValue is a (size, cookie) tuple, also available as the size
+    and cookie attributes. Unlike the one in the python ldap module, it
+    is the same for all its versions and needs no ASN.1 module.
+
+    Requests are made with PagedResultsControl.request(criticality,
+    size, cookie)
+    '''
+    controlType = CONTROL_PAGED_RESULTS
+
+    def request(cls, criticality, size, cookie=''):
+        control = cls(cls.controlType, criticality, (size, cookie or ''))
+        control.size, control.cookie = control.controlValue
+        return control
+    request = classmethod(request)
+
+    def encodeControlValue(self, *args):
+        size, cookie = self.controlValue
+        return ber_sequence(ber_integer(size),
+                            ber_encode(TAG_OCTET_STRING, cookie))
+
+    def decode(self, encodedValue):
+        tag, contents, rest = ber_decode(encodedValue)
+        items = ber_decode_sequence(contents)
+        self.size = ber_decode_integer(items[0][1])
+        self.cookie = items[1][1]
+        return (self.size, self.cookie)
+
+#
+# Kinds of Content Synchronization info messages, by BER tag
+#
+SYNC_INFO_KINDS = {0x80 : 'newcookie',
+                   0xa1 : 'refreshDelete',
+                   0xa2 : 'refreshPresent',
+                   0xa3 : 'syncIdSet'}
+
+def decode_sync_info(value):
+    '''
+    Decodes the value of a Content Synchronization info message
+
+    Returns a (kind, cookie, flag, uuids) tuple. flag is refreshDone for
+    refreshDelete and refreshPresent messages, and refreshDeletes for
+    syncIdSet messages
+    '''
+    tag, contents, rest = ber_decode(value)
+    kind = SYNC_INFO_KINDS[tag]
+    if kind == 'newcookie':
+        return (kind, contents, None, [])
+
+    cookie = None
+    flag = kind != 'syncIdSet'
+    uuids = []
+    for tag, value in ber_decode_sequence(contents):
+        if tag == TAG_OCTET_STRING:
+            cookie = value
+        elif tag == TAG_BOOLEAN:
+            flag = ber_decode_integer(value) != 0
+        elif tag == 0x31:
+            uuids = [v for t, v in ber_decode_sequence(value)]
+    return (kind, cookie, flag, uuids)
+
+#
+# Let the python ldap module decode our response controls
+#
+for control_class in (SortResponseControl, VLVResponseControl,
+                      SyncStateControl, SyncDoneControl, PagedResultsControl):
+    KNOWN_RESPONSE_CONTROLS[control_class.controlType] = control_class
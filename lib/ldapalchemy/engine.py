@@ -29,12 +29,37 @@ engine.py
    Provides a create_engine function
 '''
 
-__all__ = ['Engine', 'create_engine']
+__all__ = ['Engine', 'PooledEngine', 'AsyncEngine', 'ReplicatedEngine',
+           'create_engine', 'ROUTE_ROUND_ROBIN', 'ROUTE_LEAST_LATENCY']
+
+import time
+import select
+import threading
+import itertools
 
 import ldap
 import ldapurl
 
+from ldapalchemy.pool import ConnectionPool
+from ldapalchemy.cache import ResultCache
+
+#
+# Connection methods that do not change the directory, and thus can be
+# routed to read replicas
+#
+READ_METHODS = ('search_s', 'search_ext', 'search_ext_s', 'compare_s',
+                'search_subschemasubentry_s', 'read_subschemasubentry_s')
+
+#
+# How ReplicatedEngine picks a replica for read operations
+#
+(ROUTE_ROUND_ROBIN,
+ ROUTE_LEAST_LATENCY) = range(2)
+
 class Engine:
+
+    _supported_controls = None
+
     def __init__(self, url, **kwargs):
         if not ldapurl.isLDAPUrl(url):
             #
@@ -43,7 +68,6 @@ class Engine:
             url = 'ldap://%s' % url
 
         self.url = url
-        self._initialize()
 
         self._username = ''
         self._password = ''
@@ -61,6 +85,37 @@ class Engine:
                 self._password = kwargs[key]
                 break
 
+        self._setup_cache(kwargs)
+        self._connect()
+
+    def _setup_cache(self, kwargs):
+        '''
+        Sets up the (opt-in) cache of search results
+
+        It is enabled by the cache_size argument, the maximum number of
+        cached results. cache_ttl (default 60 seconds) and
+        cache_max_entries (total number of entries over all results) are
+        optional.
+        '''
+        self.cache = None
+        if kwargs.get('cache_size'):
+            self.cache = ResultCache(kwargs['cache_size'],
+                                     kwargs.get('cache_ttl', 60),
+                                     kwargs.get('cache_max_entries'))
+
+    def _entry_changed(self, dn, subtree=False):
+        '''
+        Called whenever an entry is added, modified or deleted through
+        this engine. subtree tells that the entries below it changed too
+        '''
+        if self.cache is not None:
+            self.cache.invalidate(dn, subtree)
+
+    def _connect(self):
+        '''
+        Sets up the connection(s) used by this engine
+        '''
+        self._initialize()
         self._bind()
 
     def _initialize(self):
@@ -77,9 +132,413 @@ class Engine:
         self._bind_status = self._connection.bind_s(self._username,
                                                     self._password)
 
+    def _create_connection(self):
+        '''
+        Returns a new connection, already bound to the LDAP directory
+        '''
+        connection = ldap.initialize(self.url)
+        connection.protocol_version = ldap.VERSION3
+        connection.bind_s(self._username, self._password)
+        return connection
+
+    def _checkout(self, readonly=False):
+        '''
+        Returns the connection to be used for the next operation
+
+        readonly tells whether the operation only reads from the directory
+        '''
+        if self._connection is None:
+            self._connect()
+        return self._connection
+
+    def _checkin(self, connection):
+        '''
+        Gives back a connection obtained with _checkout()
+        '''
+        pass
+
+    def _invalidate(self, connection):
+        '''
+        Drops a connection that was found to be dead. A new one will be
+        set up on the next checkout
+        '''
+        self._connection = None
+
+    def _call(self, method, *args, **kwargs):
+        '''
+        Calls the given method on a checked out connection
+        '''
+        connection = self._checkout(method in READ_METHODS)
+        try:
+            try:
+                return getattr(connection, method)(*args, **kwargs)
+            except ldap.SERVER_DOWN:
+                self._invalidate(connection)
+                raise
+        finally:
+            self._checkin(connection)
+
+    def supported_controls(self):
+        '''
+        Returns the OIDs of the controls supported by the server, as
+        advertised in its root DSE
+        '''
+        if self._supported_controls is None:
+            result = self._call('search_s', '', ldap.SCOPE_BASE,
+                                '(objectClass=*)', ['supportedControl'])
+            controls = []
+            for dn, entry in result:
+                for key, values in entry.items():
+                    if key.lower() == 'supportedcontrol':
+                        controls += values
+            self._supported_controls = controls
+        return self._supported_controls
+
+    def supports_control(self, oid):
+        '''
+        Returns True if the server advertises support for the given control
+        '''
+        return oid in self.supported_controls()
+
+    def _max_outstanding(self):
+        '''
+        Returns how many operations can be outstanding at the same time
+        without waiting for a connection, or None if there is no limit
+        '''
+        return None
+
+    def _issued(self, result):
+        '''
+        Called with the AsyncResult of every asynchronous operation issued
+        through this engine
+        '''
+        pass
+
+
+class PooledEngine(Engine):
+    '''
+    An engine that hands out a pooled connection for each operation
+
+    This allows multiple threads to talk to the directory at the same time,
+    instead of serializing on a single connection.
+    '''
+    def __init__(self, url, pool_size=5, max_overflow=10, pool_timeout=30,
+                 pool_recycle=-1, **kwargs):
+        self._pool_size = pool_size
+        self._max_overflow = max_overflow
+        self._pool_timeout = pool_timeout
+        self._pool_recycle = pool_recycle
+
+        Engine.__init__(self, url, **kwargs)
+
+    def _connect(self):
+        '''
+        Sets up the pool and checks that we can actually bind
+        '''
+        self.pool = ConnectionPool(self._create_connection,
+                                   pool_size=self._pool_size,
+                                   max_overflow=self._max_overflow,
+                                   timeout=self._pool_timeout,
+                                   recycle=self._pool_recycle)
+        self.pool.checkin(self.pool.checkout())
+
+    def _checkout(self, readonly=False):
+        return self.pool.checkout()
+
+    def _checkin(self, connection):
+        self.pool.checkin(connection)
+
+    def _invalidate(self, connection):
+        self.pool.invalidate(connection)
+
+    def _max_outstanding(self):
+        if self._max_overflow < 0:
+            return None
+        return self._pool_size + self._max_overflow
+
+    def dispose(self):
+        '''
+        Closes all idle connections in the pool
+        '''
+        self.pool.dispose()
+
+
+class AsyncEngine(Engine):
+    '''
+    An engine meant to be driven by an event loop
+
+    All operations share a single connection. Asynchronous operations
+    (see execute_async() in expressions) are tracked by the engine, and
+    their results are dispatched to callbacks by process(), which should
+    be called whenever fileno() becomes readable. This plugs into
+    gobject.io_add_watch(), asyncore, Twisted and the like, so that many
+    operations can be in flight without using threads.
+    '''
+    def __init__(self, url, **kwargs):
+        self._pending = []
+        Engine.__init__(self, url, **kwargs)
+
+    def _issued(self, result):
+        self._pending.append(result)
+
+    def fileno(self):
+        '''
+        Returns the file descriptor of the underlying connection
+        '''
+        return self._checkout().get_option(ldap.OPT_DESC)
+
+    def pending(self):
+        '''
+        Returns the number of operations still waiting for results
+        '''
+        return len(self._pending)
+
+    def process(self):
+        '''
+        Dispatches whatever results have already arrived, without blocking
+
+        Returns the number of operations that completed
+        '''
+        completed = 0
+        for result in self._pending[:]:
+            if result.done():
+                self._pending.remove(result)
+                completed += 1
+        return completed
+
+    def run(self, timeout=None):
+        '''
+        A minimal event loop: dispatches results until no operation is
+        pending, or nothing arrives within timeout seconds
+        '''
+        while self._pending:
+            #
+            # libldap might have already buffered more results than what
+            # was dispatched, so only wait on the descriptor when idle
+            #
+            if self.process():
+                continue
+            readable = select.select([self], [], [], timeout)[0]
+            if not readable:
+                break
+            self.process()
+
+
+class _Server:
+    '''
+    Keeps track of the state of one of the servers of a ReplicatedEngine
+    '''
+    def __init__(self, url, kwargs):
+        self.url = url
+        self.kwargs = kwargs
+        self.engine = None
+        self.alive = False
+        self.latency = None
+
+    def connect(self):
+        '''
+        Creates the engine for this server, if not created yet. Returns
+        False if the server could not be reached
+        '''
+        if self.engine is None:
+            try:
+                self.engine = create_engine(self.url, **self.kwargs)
+            except ldap.LDAPError:
+                self.alive = False
+                return False
+        self.alive = True
+        return True
+
+    def probe(self):
+        '''
+        Checks whether the server is alive, and measures its latency
+        '''
+        if not self.connect():
+            return
+
+        start = time.time()
+        try:
+            self.engine._call('search_s', '', ldap.SCOPE_BASE,
+                              '(objectClass=*)', ['1.1'])
+        except ldap.LDAPError:
+            self.alive = False
+            return
+
+        elapsed = time.time() - start
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency = 0.7 * self.latency + 0.3 * elapsed
+        self.alive = True
+
+class ReplicatedEngine(Engine):
+    '''
+    An engine spanning a writable provider and a set of read replicas
+
+    Read operations (searches) are routed to the replicas, either in a
+    round robin fashion or to the one with the least latency. Writes go to
+    the provider. When a replica fails, it is taken out of rotation and
+    reads fail over to the next one, and to the provider as a last resort.
+    A background thread probes all servers every probe_interval seconds,
+    bringing failed ones back and measuring latencies.
+
+    Every other keyword argument is used when creating the engine for each
+    server, so credentials and pool arguments apply to all of them.
+    '''
+    def __init__(self, provider, replicas, strategy=ROUTE_ROUND_ROBIN,
+                 probe_interval=30, **kwargs):
+        self.url = provider
+        self.strategy = strategy
+        self.probe_interval = probe_interval
+
+        #
+        # The cache belongs to this engine, not to each server's
+        #
+        self._setup_cache(kwargs)
+        for key in CACHE_ARGS:
+            if kwargs.has_key(key):
+                del kwargs[key]
+
+        self.provider = _Server(provider, kwargs)
+        self.replicas = [_Server(url, kwargs) for url in replicas]
+
+        self._counter = itertools.count()
+        self._owners = {}
+        self._owners_lock = threading.Lock()
+
+        #
+        # The provider is required to be up at creation time, just like
+        # for a regular engine
+        #
+        self.provider.engine = create_engine(provider, **kwargs)
+        self.provider.alive = True
+        for replica in self.replicas:
+            replica.probe()
+
+        self._stop_probing = threading.Event()
+        if probe_interval:
+            self._prober = threading.Thread(target=self.__probe_loop)
+            self._prober.setDaemon(True)
+            self._prober.start()
+
+    def __probe_loop(self):
+        while not self._stop_probing.isSet():
+            self._stop_probing.wait(self.probe_interval)
+            if self._stop_probing.isSet():
+                break
+            for server in [self.provider] + self.replicas:
+                server.probe()
+
+    def __candidates(self):
+        '''
+        Returns the live replicas in the order they should be tried
+        '''
+        alive = [r for r in self.replicas if r.alive]
+        if not alive:
+            return []
+
+        if self.strategy == ROUTE_LEAST_LATENCY:
+            measured = [(r.latency is None, r.latency, r) for r in alive]
+            measured.sort()
+            return [m[2] for m in measured]
+
+        start = self._counter.next() % len(alive)
+        return alive[start:] + alive[:start]
+
+    def __checkout_from(self, server, readonly):
+        connection = server.engine._checkout(readonly)
+        self._owners_lock.acquire()
+        try:
+            owner = self._owners.setdefault(id(connection), [server, 0])
+            owner[1] += 1
+        finally:
+            self._owners_lock.release()
+        return connection
+
+    def _checkout(self, readonly=False):
+        if readonly:
+            for server in self.__candidates():
+                try:
+                    return self.__checkout_from(server, readonly)
+                except ldap.LDAPError:
+                    server.alive = False
+        return self.__checkout_from(self.provider, readonly)
+
+    def _checkin(self, connection):
+        self._owners_lock.acquire()
+        try:
+            owner = self._owners[id(connection)]
+            owner[1] -= 1
+            if not owner[1]:
+                del self._owners[id(connection)]
+        finally:
+            self._owners_lock.release()
+        owner[0].engine._checkin(connection)
+
+    def _max_outstanding(self):
+        total = 0
+        for server in [self.provider] + self.replicas:
+            if server.alive:
+                limit = server.engine._max_outstanding()
+                if limit is None:
+                    return None
+                total += limit
+        return total
+
+    def _invalidate(self, connection):
+        server = self._owners[id(connection)][0]
+        if server is not self.provider:
+            server.alive = False
+        server.engine._invalidate(connection)
+
+    def _call(self, method, *args, **kwargs):
+        '''
+        Calls the given method, retrying reads on another server when the
+        one they were sent to is found to be down
+        '''
+        if method not in READ_METHODS:
+            return Engine._call(self, method, *args, **kwargs)
+
+        attempts = len(self.replicas) + 1
+        while True:
+            attempts -= 1
+            try:
+                return Engine._call(self, method, *args, **kwargs)
+            except ldap.SERVER_DOWN:
+                if not attempts:
+                    raise
+
+    def dispose(self):
+        '''
+        Stops probing servers and closes idle pooled connections
+        '''
+        self._stop_probing.set()
+        for server in [self.provider] + self.replicas:
+            if server.engine is not None and \
+                    hasattr(server.engine, 'dispose'):
+                server.engine.dispose()
+
+
+POOL_ARGS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle')
+CACHE_ARGS = ('cache_size', 'cache_ttl', 'cache_max_entries')
 
 def create_engine(url, **kwargs):
     '''
     Creates an engine to the LDAP Directory
+
+    If any of the pool arguments (pool_size, max_overflow, pool_timeout or
+    pool_recycle) is given, a PooledEngine is created.
+
+    If url is a list of URLs, a ReplicatedEngine is created, using the
+    first one as the provider and the others as read replicas.
+
+    Giving a cache_size enables caching of search results (see
+    Engine._setup_cache).
     '''
+    if type(url) in (list, tuple):
+        return ReplicatedEngine(url[0], url[1:], **kwargs)
+
+    for key in POOL_ARGS:
+        if kwargs.has_key(key):
+            return PooledEngine(url, **kwargs)
     return Engine(url, **kwargs)
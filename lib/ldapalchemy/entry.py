@@ -0,0 +1,169 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## This file is part of LDAPAlchemy
+## Copyright (C) 2007 Cleber Rodrigues <cleber.gnu@gmail.com>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rodrigues <cleber.gnu@gmail.com>
+##
+'''
+entry.py
+
+   Provides the objects returned by searches
+'''
+
+__all__ = ['Entry', 'AttributeAliases']
+
+from ldapalchemy.schema import ElementNotFoundError
+
+class AttributeAliases(object):
+    '''
+    Knows the alternative names of attribute types, as in "cn" and
+    "commonName", according to a schema
+
+    Lookups are remembered, so a single instance should be shared by all
+    entries coming from the same schema.
+    '''
+    def __init__(self, schema):
+        self.schema = schema
+        self._aliases = {}
+
+    def get(self, name):
+        '''
+        Returns the (lower case) names of the attribute type called name,
+        or an empty tuple if the schema does not know it
+        '''
+        key = name.lower()
+        aliases = self._aliases.get(key)
+        if aliases is None:
+            aliases = tuple([n.lower() for n in self.__get_names(name)])
+            self._aliases[key] = aliases
+        return aliases
+
+    def __get_names(self, name):
+        if self.schema is None:
+            return []
+        try:
+            return self.schema.get_element_names(
+                self.schema.get_at_by_name(name))
+        except ElementNotFoundError:
+            return []
+
+class Entry(object):
+    '''
+    A entry found by a search
+
+    The raw result sent by the server is kept as is, and only indexed on
+    the first attribute lookup. Lookups are case insensitive, and also
+    find the attribute by any of its names in the schema:
+
+       >>> entry['commonName'] == entry['CN'] == entry['cn']
+
+    For compatibility with code expecting (dn, attributes) tuples, entries
+    can be unpacked and indexed like such tuples:
+
+       >>> dn, attributes = entry
+       >>> entry[1]['cn']
+    '''
+    __slots__ = ('dn', 'attributes', '_index', '_aliases')
+
+    def __init__(self, dn, attributes, aliases=None):
+        self.dn = dn
+        self.attributes = attributes
+        self._index = None
+        self._aliases = aliases
+
+    def __lookup(self, name):
+        '''
+        Returns the values of the named attribute, or None
+        '''
+        values = self.attributes.get(name)
+        if values is not None:
+            return values
+
+        index = self._index
+        if index is None:
+            index = {}
+            for key, values in self.attributes.iteritems():
+                index[key.lower()] = values
+            self._index = index
+
+        values = index.get(name.lower())
+        if values is None and self._aliases is not None:
+            for alias in self._aliases.get(name):
+                values = index.get(alias)
+                if values is not None:
+                    break
+        return values
+
+    def __getitem__(self, key):
+        if not isinstance(key, basestring):
+            return (self.dn, self.attributes)[key]
+
+        values = self.__lookup(key)
+        if values is None:
+            raise KeyError, key
+        return values
+
+    def get(self, name, default=None):
+        '''
+        Returns the values of the named attribute, or default
+        '''
+        values = self.__lookup(name)
+        if values is None:
+            return default
+        return values
+
+    def first(self, name, default=None):
+        '''
+        Returns the first value of the named attribute, or default
+        '''
+        values = self.__lookup(name)
+        if not values:
+            return default
+        return values[0]
+
+    def has_key(self, name):
+        return self.__lookup(name) is not None
+
+    __contains__ = has_key
+
+    def keys(self):
+        return self.attributes.keys()
+
+    #
+    # Tuple compatibility
+    #
+    def __len__(self):
+        return 2
+
+    def __iter__(self):
+        return iter((self.dn, self.attributes))
+
+    def __eq__(self, other):
+        if isinstance(other, Entry):
+            other = (other.dn, other.attributes)
+        return (self.dn, self.attributes) == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return '<Entry %s>' % self.dn
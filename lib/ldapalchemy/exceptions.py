@@ -35,8 +35,17 @@ __all__ = ['EntryAlreadyExists',
            'AddExpressionEntryAlreadyExists', 
            'AddExpressionAttrNotMay', 
            'AddExpressionAttrNotMust', 
+           'AddExpressionAttrNotSingleValue',
+           'AddExpressionAttrInvalidSyntax',
+           'ModifyExpressionAttrNotMay',
+           'ModifyExpressionAttrNotMust',
+           'ModifyExpressionAttrNotSingleValue',
+           'ModifyExpressionAttrInvalidSyntax',
+           'ModifyExpressionRdnNotSet',
            'NoEngineInTemplateSchema',
-           'LDAPInvalidURI', ]
+           'LDAPInvalidURI',
+           'PoolTimeout',
+           'SessionInvalidChange', ]
 
 #
 # Most of the exceptions exist in python-ldap. The idea here is to isolate 
@@ -83,6 +92,55 @@ class AddExpressionAttrNotMust(Exception):
     '''
     pass
 
+class AddExpressionAttrNotSingleValue(Exception):
+    '''
+    In a Add expression, user provided many values for a attribute that
+    is SINGLE-VALUE in the schema
+    '''
+    pass
+
+class AddExpressionAttrInvalidSyntax(Exception):
+    '''
+    In a Add expression, user provided a value that does not conform to
+    the syntax of the attribute
+    '''
+    pass
+
+class ModifyExpressionAttrNotMay(Exception):
+    '''
+    In a Modify expression, user provided a attribute that is not allowed
+    (present in the "may" list of the template)
+    '''
+    pass
+
+class ModifyExpressionAttrNotMust(Exception):
+    '''
+    In a Modify expression, user tried to remove all values of a mandatory
+    attribute
+    '''
+    pass
+
+class ModifyExpressionAttrNotSingleValue(Exception):
+    '''
+    In a Modify expression, user provided many values for a attribute that
+    is SINGLE-VALUE in the schema
+    '''
+    pass
+
+class ModifyExpressionAttrInvalidSyntax(Exception):
+    '''
+    In a Modify expression, user provided a value that does not conform to
+    the syntax of the attribute
+    '''
+    pass
+
+class ModifyExpressionRdnNotSet(Exception):
+    '''
+    In a Modify expression, user did not provide the value of the RDN
+    attribute, needed to find the entry being modified
+    '''
+    pass
+
 class NoEngineInTemplateSchema(Exception):
     '''
     FIXME
@@ -93,3 +151,17 @@ class LDAPInvalidURI(Exception):
     '''
     '''
     pass
+
+class PoolTimeout(Exception):
+    '''
+    No connection became available in the pool before the timeout expired
+    '''
+    pass
+
+class SessionInvalidChange(Exception):
+    '''
+    A change recorded in a session conflicts with the changes already
+    pending for the same entry, such as adding a entry twice or modifying
+    a entry that is going to be deleted
+    '''
+    pass
@@ -29,16 +29,404 @@ expression.py
    Provides functionality related to add, mod, search expressions
 '''
 
-__all__ = ['Add', 'Modify', 'Delete', 'Search']
+__all__ = ['Add', 'Modify', 'Delete', 'Search', 'AsyncResult',
+           'DeferredResult', 'ALL_ATTRIBUTES', 'NO_ATTRIBUTES',
+           'TEMPLATE_ATTRIBUTES', 'DEFAULT_ATTRIBUTES']
 
+import re
+import copy
+import time
+import collections
+import base64
 import ldap
+import ldap.dn
 
 from ldapalchemy.config import DefaultConfig
+from ldapalchemy.controls import SortRequestControl, VLVRequestControl
+from ldapalchemy.controls import CONTROL_SORT_REQUEST, CONTROL_VLV_REQUEST
+from ldapalchemy.controls import CONTROL_VLV_RESPONSE
+from ldapalchemy.controls import TreeDeleteControl, CONTROL_TREE_DELETE
+from ldapalchemy.controls import PagedResultsControl, CONTROL_PAGED_RESULTS
+from ldapalchemy.engine import READ_METHODS
+from ldapalchemy.entry import Entry
+from ldapalchemy.filters import and_, Comparison
 from ldapalchemy.schema import SchemaEngineParser
+from ldapalchemy.util import normalize_dn, dn_ancestors
 
 from ldapalchemy.exceptions import NoEngineInTemplateSchema
 from ldapalchemy.exceptions import AddExpressionAttrNotMay
 from ldapalchemy.exceptions import AddExpressionAttrNotMust
+from ldapalchemy.exceptions import AddExpressionAttrNotSingleValue
+from ldapalchemy.exceptions import AddExpressionAttrInvalidSyntax
+from ldapalchemy.exceptions import AddExpressionEntryAlreadyExists
+from ldapalchemy.exceptions import ModifyExpressionAttrNotMay
+from ldapalchemy.exceptions import ModifyExpressionAttrNotMust
+from ldapalchemy.exceptions import ModifyExpressionAttrNotSingleValue
+from ldapalchemy.exceptions import ModifyExpressionAttrInvalidSyntax
+from ldapalchemy.exceptions import ModifyExpressionRdnNotSet
+
+#
+# Special values for the list of attributes requested by searches
+#
+ALL_ATTRIBUTES = None               # all user attributes
+NO_ATTRIBUTES = ['1.1']             # no attributes at all, just the DNs
+TEMPLATE_ATTRIBUTES = 'template'    # the attributes known to the template
+
+#
+# Default for the attrs argument of Search methods, meaning the attributes
+# given to the Search. ALL_ATTRIBUTES can't be used, since it is None
+#
+DEFAULT_ATTRIBUTES = object()
+
+#
+# How long a fan out search waits on a single piece before polling the others
+#
+FANOUT_POLL_INTERVAL = 0.05
+
+#
+# LDIF values that can be written as is (SAFE-STRING in RFC 2849). Others
+# are base64 encoded
+#
+LDIF_SAFE_STRING_RE = re.compile('^([\x01-\x09\x0b\x0c\x0e-\x1f\x21-\x39'
+                                 '\x3b\x3d-\x7f][\x01-\x09\x0b\x0c'
+                                 '\x0e-\x7f]*)?\\Z')
+
+#
+# LDIF lines longer than this are folded
+#
+LDIF_LINE_WIDTH = 76
+
+def ldif_line(name, value):
+    '''
+    Returns the LDIF line(s) for a attribute value, base64 encoding and
+    folding it as needed
+    '''
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+
+    if LDIF_SAFE_STRING_RE.match(value) and not value.endswith(' '):
+        line = '%s: %s' % (name, value)
+    else:
+        line = '%s:: %s' % (name, base64.b64encode(value))
+
+    if len(line) <= LDIF_LINE_WIDTH:
+        return line
+
+    width = LDIF_LINE_WIDTH - 1
+    lines = [line[:LDIF_LINE_WIDTH]]
+    for i in range(LDIF_LINE_WIDTH, len(line), width):
+        lines.append(' ' + line[i:i + width])
+    return '\n'.join(lines)
+
+def cancelled_error():
+    '''
+    Returns the error cancelled operations fail with
+    '''
+    return ldap.USER_CANCELLED({'desc' : 'Operation abandoned'})
+
+class AsyncResult(object):
+    '''
+    A handle for an operation issued asynchronously
+
+    Holds the connection the operation was issued on, along with its
+    message id. The connection is given back to the engine as soon as the
+    result is collected (or the operation is abandoned).
+
+    Results are read as they arrive, so search entries can be handed to a
+    callback one at a time (see stream_to()) instead of being collected.
+    '''
+    def __init__(self, engine, connection, msgid):
+        self.engine = engine
+        self.connection = connection
+        self.msgid = msgid
+
+        self._done = False
+        self._entries = []
+        self._result = None
+        self._error = None
+
+        self._callbacks = []
+        self._entry_callback = None
+
+    def __collect(self, timeout):
+        '''
+        Reads whatever arrives for this operation, for up to timeout
+        seconds, until the operation completes. A zero timeout only reads
+        what is already available.
+        '''
+        if timeout > 0:
+            deadline = time.time() + timeout
+
+        while not self._done:
+            try:
+                rtype, rdata, rmsgid, rctrls = \
+                    self.connection.result3(self.msgid, 0, timeout)
+            except ldap.TIMEOUT:
+                raise
+            except ldap.SERVER_DOWN, error:
+                self.engine._invalidate(self.connection)
+                self.__finish(None, error)
+                return
+            except ldap.LDAPError, error:
+                self.__finish(None, error)
+                return
+
+            if rtype is None:
+                return
+
+            if rtype in (ldap.RES_SEARCH_ENTRY, ldap.RES_SEARCH_REFERENCE):
+                for entry in rdata:
+                    self.__deliver(entry)
+                if timeout > 0:
+                    timeout = max(deadline - time.time(), 0)
+            else:
+                self.__finish(self._entries, None)
+
+    def __deliver(self, entry):
+        if self._entry_callback is not None:
+            self._entry_callback(entry)
+        else:
+            self._entries.append(entry)
+
+    def __finish(self, result, error):
+        self._done = True
+        self._result = result
+        self._error = error
+        self.engine._checkin(self.connection)
+        self.connection = None
+
+        for callback, errback in self._callbacks:
+            if error is None:
+                callback(result)
+            elif errback is not None:
+                errback(error)
+
+    def add_callback(self, callback, errback=None):
+        '''
+        Registers functions to be called when the operation completes
+
+        callback receives the result, errback receives the error raised
+        by the server, if any. If the operation has already completed,
+        they are called right away
+        '''
+        if not self._done:
+            self._callbacks.append((callback, errback))
+        elif self._error is None:
+            callback(self._result)
+        elif errback is not None:
+            errback(self._error)
+
+    def stream_to(self, callback):
+        '''
+        Hands each search entry to callback as soon as it arrives, instead
+        of collecting them for result()
+        '''
+        self._entry_callback = callback
+
+    def done(self, timeout=0):
+        '''
+        Returns True if the operation has completed
+
+        By default this does not block. A positive timeout waits up to that
+        many seconds for results to arrive.
+        '''
+        if not self._done:
+            try:
+                self.__collect(timeout)
+            except ldap.TIMEOUT:
+                pass
+        return self._done
+
+    def result(self, timeout=-1):
+        '''
+        Returns the result of the operation, waiting for it if needed
+
+        For searches, this is the list of entries found. Errors returned
+        by the server are raised here. A negative timeout waits forever.
+        '''
+        if not self._done:
+            self.__collect(timeout)
+            if not self._done:
+                raise ldap.TIMEOUT
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def cancel(self):
+        '''
+        Abandons the operation, if it is still pending
+
+        The operation then counts as failed with ldap.USER_CANCELLED: it
+        is raised by result() and handed to the errbacks registered
+        '''
+        if not self._done:
+            try:
+                self.connection.abandon(self.msgid)
+            finally:
+                self.__finish(None, cancelled_error())
+
+class DeferredResult(object):
+    '''
+    A handle for an operation that is only issued once the operations it
+    depends on have completed
+
+    It is used as a AsyncResult. Waiting for it first waits for the
+    operations it depends on, whose completion gets it issued. If it is
+    never issued, because one of those failed or it was cancelled, it
+    fails with the same error.
+    '''
+    def __init__(self, depends):
+        self._depends = depends
+        self._handle = None
+        self._error = None
+        self._callbacks = []
+
+    def _issue(self, function):
+        '''
+        Issues the operation by calling function, which returns its
+        AsyncResult
+        '''
+        if self._error is not None:
+            return
+        try:
+            self._handle = function()
+        except ldap.LDAPError, error:
+            self._fail(error)
+            return
+        for callback, errback in self._callbacks:
+            self._handle.add_callback(callback, errback)
+
+    def _fail(self, error):
+        '''
+        Gives up issuing the operation, because of error
+        '''
+        if self._error is not None:
+            return
+        self._error = error
+        for callback, errback in self._callbacks:
+            if errback is not None:
+                errback(error)
+
+    def __pending(self):
+        return self._handle is None and self._error is None
+
+    def __wait_depends(self, timeout):
+        '''
+        Waits up to timeout seconds for the operations depended on, and
+        returns the time left
+        '''
+        if timeout > 0:
+            deadline = time.time() + timeout
+        for handle in self._depends:
+            handle.done(timeout)
+            if timeout > 0:
+                timeout = max(deadline - time.time(), 0)
+        return timeout
+
+    def add_callback(self, callback, errback=None):
+        '''
+        Registers functions to be called when the operation completes, as
+        AsyncResult.add_callback()
+        '''
+        if self._handle is not None:
+            self._handle.add_callback(callback, errback)
+        elif self._error is not None:
+            if errback is not None:
+                errback(self._error)
+        else:
+            self._callbacks.append((callback, errback))
+
+    def done(self, timeout=0):
+        '''
+        Returns True if the operation has completed, as AsyncResult.done()
+        '''
+        if self.__pending():
+            timeout = self.__wait_depends(timeout)
+        if self._handle is not None:
+            return self._handle.done(timeout)
+        return not self.__pending()
+
+    def result(self, timeout=-1):
+        '''
+        Returns the result of the operation, waiting for it and for the
+        operations it depends on if needed, as AsyncResult.result()
+        '''
+        if self.__pending():
+            timeout = self.__wait_depends(timeout)
+        if self._handle is not None:
+            return self._handle.result(timeout)
+        if self._error is not None:
+            raise self._error
+        raise ldap.TIMEOUT
+
+    def cancel(self):
+        '''
+        Abandons the operation, or makes sure it is never issued. Either
+        way it fails with ldap.USER_CANCELLED, as AsyncResult.cancel(), so
+        the operations depending on it are not issued either
+        '''
+        if self._handle is not None:
+            self._handle.cancel()
+        else:
+            self._fail(cancelled_error())
+
+def execute_async(engine, method, *args):
+    '''
+    Issues the given asynchronous method on a connection checked out from
+    engine and returns a AsyncResult for it
+    '''
+    connection = engine._checkout(method in READ_METHODS)
+    try:
+        msgid = getattr(connection, method)(*args)
+    except ldap.SERVER_DOWN:
+        engine._invalidate(connection)
+        engine._checkin(connection)
+        raise
+    except:
+        engine._checkin(connection)
+        raise
+
+    result = AsyncResult(engine, connection, msgid)
+    engine._issued(result)
+    return result
+
+def pipeline(engine, requests, window):
+    '''
+    Issues the given (method, args) requests asynchronously, keeping at
+    most window of them outstanding, and waits for all of them
+
+    Returns the outcome of each request, in order: None for success, or
+    the LDAPError it failed with. A failed request does not stop the
+    others.
+    '''
+    limit = engine._max_outstanding()
+    if limit is not None:
+        window = min(window, limit)
+    window = max(window, 1)
+
+    outcomes = [None] * len(requests)
+    pending = collections.deque()
+
+    def wait_oldest():
+        index, handle = pending.popleft()
+        try:
+            handle.result()
+        except ldap.LDAPError, error:
+            outcomes[index] = error
+
+    for index, (method, args) in enumerate(requests):
+        while len(pending) >= window:
+            wait_oldest()
+        try:
+            pending.append((index, execute_async(engine, method, *args)))
+        except ldap.LDAPError, error:
+            outcomes[index] = error
+
+    while pending:
+        wait_oldest()
+    return outcomes
 
 class BaseExpression(object):
     '''
@@ -64,47 +452,591 @@ class BaseExpression(object):
 
         return "%s=%s,%s" % (key, val, basedn)
 
+    def _execute_async(self, method, *args):
+        '''
+        Issues the given asynchronous method on a checked out connection
+        and returns a AsyncResult for it
+        '''
+        return execute_async(self.bind, method, *args)
+
+    def _paged_search(self, basedn, scope, filter_string, attrlist,
+                      page_size):
+        '''
+        Yields the (dn, attributes) tuples found by a search made with the
+        Simple Paged Results control
+        '''
+        engine = self.bind
+        connection = engine._checkout(True)
+        cookie = ''
+        try:
+            try:
+                while True:
+                    control = PagedResultsControl.request(True, page_size,
+                                                          cookie)
+                    msgid = connection.search_ext(basedn, scope,
+                                                  filter_string, attrlist,
+                                                  serverctrls=[control])
+                    rtype, rdata, rmsgid, rctrls = connection.result3(msgid)
+
+                    cookie = ''
+                    for rctrl in rctrls:
+                        if rctrl.controlType == CONTROL_PAGED_RESULTS:
+                            cookie = rctrl.controlValue[1]
+
+                    for entry in rdata:
+                        yield entry
+
+                    if not cookie:
+                        break
+            except ldap.SERVER_DOWN:
+                engine._invalidate(connection)
+                raise
+        finally:
+            #
+            # If the caller stopped before the last page, tell the server
+            # it can release the results (a page size of zero does that)
+            #
+            if cookie:
+                self.__release_paged_search(connection, basedn, scope,
+                                            filter_string, cookie)
+            engine._checkin(connection)
+
+    def __release_paged_search(self, connection, basedn, scope,
+                               filter_string, cookie):
+        control = PagedResultsControl.request(True, 0, cookie)
+        try:
+            connection.search_ext_s(basedn, scope, filter_string,
+                                    serverctrls=[control])
+        except ldap.LDAPError:
+            pass
+
+    def _pipeline(self, requests, window):
+        '''
+        Issues the given (method, args) requests, see pipeline()
+        '''
+        return pipeline(self.bind, requests, window)
+
 
 class Search(BaseExpression):
-    def __init__(self, template):
+    '''
+    Provides a Search expression for a template
+
+    attrs is the list of attributes that should be returned for each entry
+    found. Besides a list of names, it can be ALL_ATTRIBUTES, NO_ATTRIBUTES
+    or TEMPLATE_ATTRIBUTES. It can also be overridden on each call, including
+    with ALL_ATTRIBUTES to widen a search made with a narrower list.
+
+    Entries found are returned as Entry objects (see ldapalchemy.entry),
+    except by execute_async(), which returns (dn, attributes) tuples.
+    Their values are strings, as sent by the server, unless the search is
+    made with decoded().
+    '''
+    def __init__(self, template, attrs=ALL_ATTRIBUTES):
         self.template = template
+        self.attrs = attrs
+        self._whereclauses = []
+        self._codecs = None
 
-    def __check_params(self, **params):
+    def _get_attrlist(self, attrs):
         '''
-        Deal with parameters passed in as keyword args
+        Returns the attribute list to send to the server
         '''
-        params['objectClass'] = self.template.object_class_names
+        if attrs is DEFAULT_ATTRIBUTES:
+            attrs = self.attrs
+        if attrs == TEMPLATE_ATTRIBUTES:
+            attrs = []
+            for name in self.template.attribute_names:
+                if name not in attrs:
+                    attrs.append(name)
+        return attrs
 
-        return params
+    def where(self, *clauses):
+        '''
+        Returns a new Search that also requires the given filter clauses
+        (see ldapalchemy.filters) to match
+        '''
+        search = copy.copy(self)
+        search._whereclauses = self._whereclauses + list(clauses)
+        return search
 
-    def __build_filter_string(self, **params):
+    def decoded(self):
         '''
-        Construct a filters string based on this expression's template
-        and supplied params
+        Returns a new Search whose entries have their values converted to
+        Python types, according to the attribute syntaxes (see
+        ldapalchemy.syntaxes)
         '''
-        params = self.__check_params(**params)
-        params_keys = params.keys()
+        search = copy.copy(self)
+        search._codecs = self.template.codecs
+        return search
+
+    def _build_filter(self, **params):
+        '''
+        Construct a filter element based on this expression's template,
+        its where clauses and the supplied params
+
+        Params are ANDed equality matches. A list of values matches entries
+        that have all of them. Values can be Python types, see
+        ldapalchemy.syntaxes.
+        '''
+        clauses = [Comparison('objectClass', '=', name) \
+                       for name in self.template.object_class_names]
 
-        filter_items = []
+        params = self.template.codecs.encode(params)
 
+        params_keys = params.keys()
+        params_keys.sort()
         for k in params_keys:
             v = params[k]
             if type(v) != list:
                 v = [v, ]
             for i in v:
-                filter_items.append("(%s=%s)" % (k, i))
+                clauses.append(Comparison(k, '=', i))
 
-        filter = "(&%s)" % "".join(filter_items)
+        return and_(*(clauses + self._whereclauses))
 
-        return filter
+    def __build_filter_string(self, **params):
+        '''
+        Construct a filters string based on this expression's template
+        and supplied params
+        '''
+        filter = self._build_filter(**params)
+        return self.template.optimizer.optimize(filter).compile()
 
-    def execute(self, basedn, scope=ldap.SCOPE_SUBTREE, **params):
+    def explain(self, **params):
+        '''
+        Returns a report on how the filter for the given params is
+        optimized, and whether its terms hit indexed attributes
+        '''
+        filter = self._build_filter(**params)
+        return self.template.optimizer.explain(filter)
+
+    def execute(self, basedn, scope=ldap.SCOPE_SUBTREE,
+                attrs=DEFAULT_ATTRIBUTES, sort=None, **params):
         '''
         Execute a search 
+
+        sort is a list of sort keys (see SortRequestControl), such as
+        ['cn', '-uidNumber']. Sorting is done by the server.
+
+        If the engine has a result cache, results are looked up there
+        first, and cached for the template's cache_ttl
+        '''
+        filter_string = self.__build_filter_string(**params)
+        attrlist = self._get_attrlist(attrs)
+
+        engine = self.bind
+        if engine.cache is None:
+            return self._make_entries(self.__search(engine, basedn, scope,
+                                                    filter_string, attrlist,
+                                                    sort))
+
+        key = engine.cache.make_key(basedn, scope, filter_string, attrlist,
+                                    sort)
+        result = engine.cache.get(key)
+        if result is None:
+            result = self.__search(engine, basedn, scope, filter_string,
+                                   attrlist, sort)
+            engine.cache.put(key, result, self.template.cache_ttl)
+        return self._make_entries(result)
+
+    def execute_local(self, replica, basedn, scope=ldap.SCOPE_SUBTREE,
+                      attrs=DEFAULT_ATTRIBUTES, **params):
+        '''
+        Execute a search against the entries held in memory by replica (a
+        SyncReplConsumer), without contacting the server
+        '''
+        return self._make_entries(replica.find(basedn, scope,
+                                               self._build_filter(**params),
+                                               self._get_attrlist(attrs)))
+
+    def _make_entries(self, result):
+        '''
+        Wraps the (dn, attributes) tuples of a result in Entry objects
+        '''
+        if self._codecs is not None:
+            result = self._codecs.decode_result(result)
+        aliases = self.template.aliases
+        return [Entry(dn, attributes, aliases) for dn, attributes in result]
+
+    def _make_entry(self, dn, attributes):
+        '''
+        Wraps a single (dn, attributes) tuple in a Entry object
+        '''
+        if self._codecs is not None:
+            attributes = self._codecs.decode(attributes)
+        return Entry(dn, attributes, self.template.aliases)
+
+    def __search(self, engine, basedn, scope, filter_string, attrlist, sort):
+        if not sort:
+            return engine._call('search_s', basedn, scope, filter_string,
+                                attrlist)
+
+        control = SortRequestControl(True, sort)
+        return engine._call('search_ext_s', basedn, scope, filter_string,
+                            attrlist, 0, [control])
+
+    def slice(self, basedn, start, stop, sort, scope=ldap.SCOPE_SUBTREE,
+              attrs=DEFAULT_ATTRIBUTES, **params):
+        '''
+        Returns a window of the sorted results, as a (entries, count) tuple
+
+        entries are the results from position start up to (but not
+        including) stop, counting from zero as in python slices, when
+        sorted by the given sort keys. count is the total number of
+        entries matching the search, as estimated by the server.
+
+        This uses the Virtual List View control, so only the requested
+        window is transferred. If the server does not support it, all
+        results are fetched and sliced here.
+        '''
+        filter_string = self.__build_filter_string(**params)
+        attrlist = self._get_attrlist(attrs)
+
+        engine = self.bind
+        if not engine.supports_control(CONTROL_VLV_REQUEST):
+            if engine.supports_control(CONTROL_SORT_REQUEST):
+                result = self.__search(engine, basedn, scope, filter_string,
+                                       attrlist, sort)
+            else:
+                result = self.__search(engine, basedn, scope, filter_string,
+                                       None, None)
+                result = self.__sort_locally(result, sort)
+                if attrlist is not None:
+                    result = [(dn, self.__project(entry, attrlist)) \
+                                  for dn, entry in result]
+            return self._make_entries(result[start:stop]), len(result)
+
+        if stop <= start:
+            #
+            # The window is empty, but the count is still wanted. Ask for
+            # a single DN, as count() does
+            #
+            rdata, count = self.__vlv_search(engine, basedn, scope,
+                                             filter_string, NO_ATTRIBUTES,
+                                             sort, 1, 0)
+            return [], count
+
+        rdata, count = self.__vlv_search(engine, basedn, scope, filter_string,
+                                         attrlist, sort, start + 1,
+                                         stop - start - 1)
+        return self._make_entries(rdata), count
+
+    def __vlv_search(self, engine, basedn, scope, filter_string, attrlist,
+                     sort, offset, after_count):
+        '''
+        Searches for after_count + 1 entries, starting at the given (1 based)
+        offset of the sorted results
+
+        Returns the entries and the total count reported by the server
+        '''
+        sort_control = SortRequestControl(True, sort)
+        vlv_control = VLVRequestControl(True, (0, after_count, offset, 0,
+                                               None))
+
+        connection = engine._checkout(True)
+        try:
+            try:
+                msgid = connection.search_ext(basedn, scope, filter_string,
+                                              attrlist, serverctrls=[
+                                                  sort_control, vlv_control])
+                rtype, rdata, rmsgid, rctrls = connection.result3(msgid)
+            except ldap.SERVER_DOWN:
+                engine._invalidate(connection)
+                raise
+        finally:
+            engine._checkin(connection)
+
+        count = None
+        for rctrl in rctrls:
+            if rctrl.controlType == CONTROL_VLV_RESPONSE:
+                count = rctrl.controlValue[1]
+
+        return rdata, count
+
+    def count(self, basedn, scope=ldap.SCOPE_SUBTREE, **params):
+        '''
+        Returns the number of entries matching the search
+
+        When the server supports the Virtual List View control, it is asked
+        for the count and a single DN is transferred. Otherwise only the
+        DNs of the entries found are fetched and counted.
         '''
         filter_string = self.__build_filter_string(**params)
-        
-        return self.bind._connection.search_s(basedn, scope, filter_string)
+
+        engine = self.bind
+        if engine.supports_control(CONTROL_VLV_REQUEST):
+            sort = [self.template.rdn_attribute_name]
+            try:
+                rdata, count = self.__vlv_search(engine, basedn, scope,
+                                                 filter_string, NO_ATTRIBUTES,
+                                                 sort, 1, 0)
+                if count is not None:
+                    return count
+            except ldap.LDAPError:
+                #
+                # Servers refuse the VLV search in many ways (eg, when the
+                # RDN attribute has no ordering rule), so count the DNs
+                #
+                pass
+
+        return len(self.__search(engine, basedn, scope, filter_string,
+                                 NO_ATTRIBUTES, None))
+
+    def exists(self, basedn, scope=ldap.SCOPE_SUBTREE, **params):
+        '''
+        Returns True if at least one entry matches the search
+
+        The server is asked for at most one entry, with no attributes
+        '''
+        return self.__first(basedn, scope, NO_ATTRIBUTES, **params) is not None
+
+    def first(self, basedn, scope=ldap.SCOPE_SUBTREE,
+              attrs=DEFAULT_ATTRIBUTES, **params):
+        '''
+        Returns the first entry matching the search, or None
+
+        The server stops searching as soon as a entry is found
+        '''
+        entry = self.__first(basedn, scope, self._get_attrlist(attrs),
+                             **params)
+        if entry is not None:
+            entry = self._make_entry(entry[0], entry[1])
+        return entry
+
+    def __first(self, basedn, scope, attrlist, **params):
+        filter_string = self.__build_filter_string(**params)
+
+        engine = self.bind
+        connection = engine._checkout(True)
+        try:
+            try:
+                msgid = connection.search_ext(basedn, scope, filter_string,
+                                              attrlist, sizelimit=1)
+                while True:
+                    rtype, rdata, rmsgid, rctrls = connection.result3(msgid,
+                                                                      0)
+                    if rtype == ldap.RES_SEARCH_ENTRY:
+                        break
+                    if rtype == ldap.RES_SEARCH_RESULT:
+                        return None
+
+                #
+                # Collect the final result, which tells that the size
+                # limit was reached when there are more entries
+                #
+                try:
+                    connection.result3(msgid)
+                except ldap.SIZELIMIT_EXCEEDED:
+                    pass
+                return rdata[0]
+            except ldap.SERVER_DOWN:
+                engine._invalidate(connection)
+                raise
+        finally:
+            engine._checkin(connection)
+
+    def __sort_locally(self, result, sort):
+        '''
+        Sorts the result as the server would, comparing the first value of
+        each sort key, case insensitively
+        '''
+        control = SortRequestControl(False, sort)
+        keys = [control.parse_key(key) for key in sort]
+        keys.reverse()
+
+        result = list(result)
+        for name, ordering_rule, reverse in keys:
+            decorated = []
+            for n, (dn, entry) in enumerate(result):
+                value = None
+                for k, v in entry.items():
+                    if k.lower() == name.lower() and v:
+                        value = v[0].lower()
+                decorated.append(((value is None, value), n, (dn, entry)))
+            decorated.sort()
+            if reverse:
+                decorated.reverse()
+            result = [d[2] for d in decorated]
+        return result
+
+    def __project(self, entry, attrlist):
+        wanted = [a.lower() for a in attrlist]
+        return dict([(k, v) for k, v in entry.items() \
+                         if k.lower() in wanted])
+
+    def execute_async(self, basedn, scope=ldap.SCOPE_SUBTREE,
+                      attrs=DEFAULT_ATTRIBUTES, **params):
+        '''
+        Issues a search without waiting for its results
+
+        Returns a AsyncResult, whose result() is the list of entries found
+        '''
+        filter_string = self.__build_filter_string(**params)
+        attrlist = self._get_attrlist(attrs)
+
+        return self._execute_async('search_ext', basedn, scope, filter_string,
+                                   attrlist)
+
+    def stream(self, basedn, scope=ldap.SCOPE_SUBTREE,
+               attrs=DEFAULT_ATTRIBUTES, **params):
+        '''
+        Yields the entries found as they arrive from the server
+
+        Unlike execute(), which waits for the whole result, entries are
+        read one message at a time, so memory use does not grow with the
+        size of the result. If the caller stops early, the search is
+        abandoned.
+        '''
+        filter_string = self.__build_filter_string(**params)
+        attrlist = self._get_attrlist(attrs)
+        make_entry = self._make_entry
+
+        engine = self.bind
+        connection = engine._checkout(True)
+        msgid = None
+        try:
+            try:
+                msgid = connection.search_ext(basedn, scope, filter_string,
+                                              attrlist)
+                while True:
+                    rtype, rdata, rmsgid, rctrls = connection.result3(msgid,
+                                                                      0)
+                    if rtype == ldap.RES_SEARCH_RESULT:
+                        msgid = None
+                        break
+                    if rtype == ldap.RES_SEARCH_ENTRY:
+                        for dn, attributes in rdata:
+                            yield make_entry(dn, attributes)
+            except ldap.SERVER_DOWN:
+                msgid = None
+                engine._invalidate(connection)
+                raise
+            except ldap.LDAPError:
+                msgid = None
+                raise
+        finally:
+            if msgid is not None:
+                try:
+                    connection.abandon(msgid)
+                except ldap.LDAPError:
+                    pass
+            engine._checkin(connection)
+
+    def fanout(self, bases, scope=ldap.SCOPE_SUBTREE,
+               attrs=DEFAULT_ATTRIBUTES, unique=False, concurrency=8,
+               **params):
+        '''
+        Yields the entries found by searching several bases in parallel
+
+        bases is either a list of base DNs, each searched with the given
+        scope, or a single base DN. In the latter case, for subtree
+        searches, the base entry and each of its immediate children are
+        searched separately, so the pieces can be scanned concurrently.
+
+        Up to concurrency searches are outstanding at any time, and entries
+        are yielded as they arrive from any of them. With unique, entries
+        already yielded (same DN) are skipped, which is useful when the
+        bases overlap.
+
+        On a PooledEngine each search runs on its own connection, so
+        concurrency is capped at pool_size plus max_overflow. Other engines
+        pipeline all searches on their connection.
+        '''
+        filter_string = self.__build_filter_string(**params)
+        attrlist = self._get_attrlist(attrs)
+
+        limit = self.bind._max_outstanding()
+        if limit is not None:
+            concurrency = max(min(concurrency, limit), 1)
+
+        if isinstance(bases, basestring):
+            pieces = self.__fanout_pieces(bases, scope)
+        else:
+            pieces = [(base, scope) for base in bases]
+        pieces = collections.deque(pieces)
+
+        #
+        # Deques, as big result sets would make popping from the head of
+        # a list quadratic
+        #
+        seen = {}
+        entries = collections.deque()
+        pending = []
+        try:
+            while pieces or pending or entries:
+                while pieces and len(pending) < concurrency:
+                    base, piece_scope = pieces.popleft()
+                    handle = self._execute_async('search_ext', base,
+                                                 piece_scope, filter_string,
+                                                 attrlist)
+                    handle.stream_to(entries.append)
+                    pending.append(handle)
+
+                if pending and not entries:
+                    pending[0].done(FANOUT_POLL_INTERVAL)
+
+                for handle in pending[:]:
+                    if handle.done():
+                        pending.remove(handle)
+                        handle.result()
+
+                while entries:
+                    entry = entries.popleft()
+                    if unique:
+                        key = normalize_dn(entry[0])
+                        if seen.has_key(key):
+                            continue
+                        seen[key] = True
+                    yield self._make_entry(entry[0], entry[1])
+        finally:
+            for handle in pending:
+                handle.cancel()
+
+    def __fanout_pieces(self, basedn, scope):
+        '''
+        Splits a search on basedn into (base, scope) pieces that together
+        cover the same entries
+        '''
+        if scope != ldap.SCOPE_SUBTREE:
+            return [(basedn, scope)]
+
+        children = self.bind._call('search_s', basedn, ldap.SCOPE_ONELEVEL,
+                                   '(objectClass=*)', NO_ATTRIBUTES)
+        pieces = [(basedn, ldap.SCOPE_BASE)]
+        for dn, entry in children:
+            pieces.append((dn, ldap.SCOPE_SUBTREE))
+        return pieces
+
+    def iterate(self, basedn, scope=ldap.SCOPE_SUBTREE, page_size=1000,
+                attrs=DEFAULT_ATTRIBUTES, **params):
+        '''
+        Yields the entries found one at a time
+
+        Entries are fetched in pages of page_size entries using the Simple
+        Paged Results control (RFC 2696), so only one page is held in memory
+        at any time, and searches larger than the server size limit work.
+        '''
+        filter_string = self.__build_filter_string(**params)
+        attrlist = self._get_attrlist(attrs)
+        make_entry = self._make_entry
+
+        pages = self._paged_search(basedn, scope, filter_string, attrlist,
+                                   page_size)
+        try:
+            for dn, attributes in pages:
+                yield make_entry(dn, attributes)
+        finally:
+            pages.close()
+
+#
+# Exceptions raised for invalid params, see ValidationPlan.validate()
+#
+ADD_ERRORS = (AddExpressionAttrNotMay, AddExpressionAttrNotMust,
+              AddExpressionAttrNotSingleValue, AddExpressionAttrInvalidSyntax)
+
+MODIFY_ERRORS = (ModifyExpressionAttrNotMay, ModifyExpressionAttrNotMust,
+                 ModifyExpressionAttrNotSingleValue,
+                 ModifyExpressionAttrInvalidSyntax)
 
 class Add(BaseExpression):
     '''
@@ -112,46 +1044,35 @@ class Add(BaseExpression):
     '''
     def __init__(self, template):
         self.template = template
+        self.__oc_lines = None
 
     def __check_params(self, **params):
         '''
         Take care of the validity of the params suplied
         '''
-
         #
-        # Every entry is supposed to have a objectClass attribute
+        # The RDN attribute is mandatory for every entry
         #
-        params['objectClass'] = self.template.object_class_names
+        if not params.has_key(self.template.rdn_attribute_name):
+            raise AddExpressionAttrNotMust, self.template.rdn_attribute_name
 
-        #
-        # Speed up by caching the keys
-        # 
-        params_keys = params.keys()
+        params = self.template.codecs.encode(params)
 
         #
-        # Check the attribute name (k) is a allowed attribute
+        # Every entry is supposed to have a objectClass attribute
         #
-        for k in params_keys:
-            if k not in self.template.attribute_names:
-                raise AddExpressionAttrNotMay, k
+        params['objectClass'] = self.template.object_class_names
 
-        #
-        # Check if all mandatory attributes have values
-        # 
-        for n in self.template.attribute_must_names:
-            if n not in params_keys:
-                raise AddExpressionAttrNotMust, n
-        
+        self.template.validation_plan.validate(params, ADD_ERRORS)
         return params
 
-    def execute(self, basedn, **params):
-
+    def __build_mod_list(self, basedn, **params):
+        '''
+        Returns the dn and the modification list to pass to add() method of
+        the ldap connection
+        '''
         params = self.__check_params(**params)
 
-        #
-        # Create the modification list to pass to add() method of the 
-        # ldap connection
-        # 
         mod_list = []
         for k, v in params.items():
             if type(v) != list:
@@ -159,8 +1080,126 @@ class Add(BaseExpression):
             mod_list.append((k, v))
 
         dn = self._build_dn(basedn, **params)
-        
-        self.bind._connection.add_s(dn, mod_list)
+
+        return dn, mod_list
+
+    def execute(self, basedn, **params):
+        dn, mod_list = self.__build_mod_list(basedn, **params)
+
+        engine = self.bind
+        engine._call('add_s', dn, mod_list)
+        engine._entry_changed(dn)
+
+    def executemany(self, basedn, rows, window=100):
+        '''
+        Adds many entries, one for each dict of params in rows
+
+        Up to window adds are sent before waiting for their responses,
+        instead of waiting for each one in turn. A failed row does not stop
+        the others: returns a list of (dn, error) tuples, one for each row,
+        where error is None if the entry was added. Otherwise it is the
+        exception for the row, such as AddExpressionAttrNotMay for invalid
+        params, AddExpressionEntryAlreadyExists, or the python ldap error
+        returned by the server (eg, ldap.CONSTRAINT_VIOLATION). dn is None
+        if the row does not have a value for the RDN attribute.
+        '''
+        results = []
+        requests = []
+        for params in rows:
+            try:
+                dn, mod_list = self.__build_mod_list(basedn, **params)
+            except ADD_ERRORS, error:
+                results.append([self.__get_dn(basedn, params), error])
+                continue
+            results.append([dn, None])
+            requests.append((len(results) - 1, ('add_ext', (dn, mod_list))))
+
+        outcomes = self._pipeline([r[1] for r in requests], window)
+
+        engine = self.bind
+        for (index, request), error in zip(requests, outcomes):
+            dn = results[index][0]
+            if isinstance(error, ldap.ALREADY_EXISTS):
+                error = AddExpressionEntryAlreadyExists(dn)
+            results[index][1] = error
+            if error is None:
+                engine._entry_changed(dn)
+
+        return [tuple(r) for r in results]
+
+    def __get_dn(self, basedn, params):
+        if not params.has_key(self.template.rdn_attribute_name):
+            return None
+        return self._build_dn(basedn, **params)
+
+    def execute_async(self, basedn, **params):
+        '''
+        Issues the add without waiting for the server response
+
+        Returns a AsyncResult. Errors such as an already existing entry
+        are raised when calling its result(). The engine caches forget
+        about the entry once the add completes
+        '''
+        dn, mod_list = self.__build_mod_list(basedn, **params)
+
+        engine = self.bind
+        result = self._execute_async('add_ext', dn, mod_list)
+        result.add_callback(lambda result: engine._entry_changed(dn))
+        return result
+
+    def __get_oc_lines(self):
+        '''
+        Returns the objectClass lines written by write_ldif() for every
+        entry. This is computed only once
+        '''
+        if self.__oc_lines is None:
+            self.__oc_lines = '\n'.join([ldif_line('objectClass', name) \
+                       for name in self.template.object_class_names])
+        return self.__oc_lines
+
+    def write_ldif(self, basedn, rows, output):
+        '''
+        Writes to the file object output the LDIF for adding one entry for
+        each dict of params in rows
+
+        Rows can come from any iterable, such as a generator, and each
+        entry is written as soon as it is built, so memory use does not
+        depend on the number of rows. The template is only inspected once.
+        Values that are not safe to write as is are base64 encoded, and
+        long lines are folded.
+
+        Returns the number of entries written. Invalid rows raise the same
+        exceptions as execute(), after the previous rows have been written.
+        '''
+        oc_lines = self.__get_oc_lines()
+        encode = self.template.codecs.encode
+        validate = self.template.validation_plan.validate
+        rdn_name = self.template.rdn_attribute_name
+
+        count = 0
+        for params in rows:
+            if not params.has_key(rdn_name):
+                raise AddExpressionAttrNotMust, rdn_name
+            params = encode(params)
+            validate(params, ADD_ERRORS)
+
+            lines = [ldif_line('dn', self._build_dn(basedn, **params)),
+                     oc_lines]
+            names = [rdn_name] + [k for k in params \
+                                      if k != rdn_name and k != 'objectClass']
+            for k in names:
+                v = params[k]
+                if type(v) != list:
+                    lines.append(ldif_line(k, v))
+                else:
+                    for val in v:
+                        lines.append(ldif_line(k, val))
+
+            lines.append('\n')
+            output.write('\n'.join(lines))
+            count += 1
+
+        return count
 
     def get_as_ldif(self, basedn, **params):
         '''
@@ -207,8 +1246,116 @@ class Modify(BaseExpression):
     def __init__(self, template):
         self.template = template
 
-    def execute(self, basedn, **params):
-        pass        
+    def __check_params(self, **params):
+        '''
+        Take care of the validity of the params suplied
+        '''
+        if not params.has_key(self.template.rdn_attribute_name):
+            raise ModifyExpressionRdnNotSet, self.template.rdn_attribute_name
+
+        plan = self.template.validation_plan
+        plan.validate(params, MODIFY_ERRORS, require=False)
+        for k, v in params.items():
+            if v in (None, []) and plan.canonical(k) in plan.required:
+                raise ModifyExpressionAttrNotMust, k
+
+    def __get_current(self, dn, names):
+        '''
+        Fetches the current values of the named attributes of entry dn
+        '''
+        result = self.bind._call('search_s', dn, ldap.SCOPE_BASE,
+                                 '(objectClass=*)', names)
+        return result[0][1]
+
+    def get_mod_list(self, basedn, current=None, **params):
+        '''
+        Returns the dn and the modification list that would be sent by
+        execute()
+
+        Only the attributes given in params are considered. Their values
+        are compared with the current ones, and only the differences are
+        sent: values added to a attribute become a MOD_ADD, values removed
+        become a MOD_DELETE. When all the values of a attribute change, a
+        single MOD_REPLACE is used if it is shorter. A value of None (or an
+        empty list) removes the attribute.
+
+        current holds the current attribute values of the entry, either as
+        a dict or as a Entry. If not given, they are fetched from the
+        server with a single base search.
+        '''
+        params = self.template.codecs.encode(params)
+        self.__check_params(**params)
+
+        dn = self._build_dn(basedn, **params)
+        rdn_name = self.template.rdn_attribute_name
+        names = [k for k in params.keys() if k != rdn_name]
+
+        if current is None:
+            current = self.__get_current(dn, names or NO_ATTRIBUTES)
+        elif isinstance(current, Entry):
+            current = current.attributes
+
+        #
+        # current may come from a decoded() search
+        #
+        current = self.template.codecs.encode(current)
+
+        current_values = {}
+        for k, v in current.items():
+            current_values[k.lower()] = v
+
+        mod_list = []
+        names.sort()
+        for name in names:
+            wanted = params[name]
+            if wanted is None:
+                wanted = []
+            elif type(wanted) != list:
+                wanted = [wanted, ]
+            wanted = [isinstance(v, unicode) and v.encode('utf-8') or str(v) \
+                          for v in wanted]
+            existing = current_values.get(name.lower(), [])
+
+            if not wanted:
+                if existing:
+                    mod_list.append((ldap.MOD_DELETE, name, None))
+                continue
+            if not existing:
+                mod_list.append((ldap.MOD_ADD, name, wanted))
+                continue
+
+            removed = [v for v in existing if v not in wanted]
+            added = [v for v in wanted if v not in existing]
+            if not removed and not added:
+                continue
+
+            if len(wanted) <= len(removed) + len(added):
+                mod_list.append((ldap.MOD_REPLACE, name, wanted))
+                continue
+            if removed:
+                mod_list.append((ldap.MOD_DELETE, name, removed))
+            if added:
+                mod_list.append((ldap.MOD_ADD, name, added))
+
+        return dn, mod_list
+
+    def execute(self, basedn, current=None, **params):
+        '''
+        Changes the entry identified by basedn and the RDN attribute value
+        in params, so that the attributes in params have the given values
+
+        See get_mod_list() for how the changes are computed. Returns the
+        modification list sent to the server, which is empty (and nothing
+        is sent) if the entry already has the given values.
+        '''
+        dn, mod_list = self.get_mod_list(basedn, current, **params)
+        if not mod_list:
+            return mod_list
+
+        engine = self.bind
+        engine._call('modify_s', dn, mod_list)
+        engine._entry_changed(dn)
+        return mod_list
 
 class Delete(BaseExpression):
     '''
@@ -217,18 +1364,169 @@ class Delete(BaseExpression):
     def __init__(self, template):
         self.template = template
 
-    def execute(self, basedn, scope=ldap.SCOPE_SUBTREE, **params):
+    def __find(self, basedn, scope, **params):
+        '''
+        Returns the DNs of the entries matching the template and params.
+        The result cache is bypassed, as a stale result would miss entries
+        '''
+        filter = Search(self.template)._build_filter(**params)
+        filter_string = self.template.optimizer.optimize(filter).compile()
+        result = self.bind._call('search_s', basedn, scope, filter_string,
+                                 NO_ATTRIBUTES)
+        return [dn for dn, entry in result]
+
+    def __find_below(self, roots, page_size):
+        '''
+        Returns the DNs of the given entries and of all entries below them
+        '''
+        engine = self.bind
+        paged = engine.supports_control(CONTROL_PAGED_RESULTS)
+
+        dns = []
+        for root in roots:
+            if paged:
+                result = self._paged_search(root, ldap.SCOPE_SUBTREE,
+                                            '(objectClass=*)', NO_ATTRIBUTES,
+                                            page_size)
+            else:
+                result = engine._call('search_s', root, ldap.SCOPE_SUBTREE,
+                                      '(objectClass=*)', NO_ATTRIBUTES)
+            dns += [dn for dn, entry in result]
+        return dns
+
+    def __remove_nested(self, dns):
         '''
-        FIXME: this should filter stuff to delete based on the template and
-        also based on the params supplied. For now, this simply deletes the
-        given DN
+        Returns the DNs that are not below any of the others
         '''
-        search = Search(self.template)
-        search_results = search.execute(basedn, scope, **params)
+        normalized = {}
+        for dn in dns:
+            normalized[normalize_dn(dn)] = True
 
-        dns = [entry[0] for entry in search_results]
+        roots = []
         for dn in dns:
-            self.bind._connection.delete_s(dn)
+            for ancestor in dn_ancestors(dn)[1:]:
+                if normalized.has_key(ancestor):
+                    break
+            else:
+                roots.append(dn)
+        return roots
+
+    def __by_depth(self, dns):
+        '''
+        Groups the DNs in waves of the same depth, deepest first. No entry
+        in a wave is below another one in the same wave
+        '''
+        waves = {}
+        for dn in dns:
+            waves.setdefault(len(ldap.dn.str2dn(dn)), []).append(dn)
+
+        depths = waves.keys()
+        depths.sort()
+        depths.reverse()
+        return [waves[depth] for depth in depths]
+
+    def execute(self, basedn, scope=ldap.SCOPE_SUBTREE, subtree=False,
+                window=100, page_size=1000, **params):
+        '''
+        Deletes the entries matching the template and params
+
+        Entries are deleted deepest first, in waves of entries of the same
+        depth. All deletes of a wave are pipelined, with up to window of
+        them outstanding, so independent branches are deleted at the same
+        time while children always go before their parents.
+
+        With subtree, everything below the entries found is deleted too.
+        If the server supports the Tree Delete control, a single request
+        is sent for each entry. Otherwise the entries below are searched
+        for (in pages of page_size) and deleted deepest first.
+
+        Returns the list of DNs deleted. If the server refuses a delete,
+        the rest of its wave is still tried, but then the error is raised.
+        '''
+        dns = self.__find(basedn, scope, **params)
+
+        engine = self.bind
+        controls = None
+        if subtree:
+            dns = self.__remove_nested(dns)
+            if engine.supports_control(CONTROL_TREE_DELETE):
+                controls = [TreeDeleteControl()]
+            else:
+                dns = self.__find_below(dns, page_size)
+
+        deleted = []
+        for wave in self.__by_depth(dns):
+            requests = [('delete_ext', (dn, controls)) for dn in wave]
+            outcomes = self._pipeline(requests, window)
+
+            error = None
+            for dn, outcome in zip(wave, outcomes):
+                if outcome is None:
+                    deleted.append(dn)
+                    engine._entry_changed(dn, controls is not None)
+                elif error is None:
+                    error = outcome
+            if error is not None:
+                raise error
+
+        return deleted
+
+    def execute_async(self, basedn, scope=ldap.SCOPE_SUBTREE, **params):
+        '''
+        Searches for the entries to delete and then issues the deletes of
+        the deepest ones, without waiting for the server responses. Each
+        following wave is issued once all the deletes of the previous one
+        have completed, that is, as their results are collected.
+
+        Returns a list of handles, one for each entry being deleted. Those
+        of later waves are DeferredResult. If a delete fails or is
+        cancelled, the later waves are not issued, and their handles fail
+        with the same error.
+        '''
+        results = []
+        previous = None
+        for wave in self.__by_depth(self.__find(basedn, scope, **params)):
+            if previous is None:
+                handles = [self.__delete_async(dn) for dn in wave]
+            else:
+                handles = self.__chain(previous, wave)
+            results += handles
+            previous = handles
+        return results
+
+    def __delete_async(self, dn):
+        '''
+        Issues the delete of dn, which is forgotten by the engine caches
+        once it completes
+        '''
+        engine = self.bind
+        handle = self._execute_async('delete_ext', dn)
+        handle.add_callback(lambda result: engine._entry_changed(dn))
+        return handle
+
+    def __chain(self, previous, wave):
+        '''
+        Returns DeferredResult handles for the deletes of wave, which are
+        issued once all the previous handles have completed
+        '''
+        handles = [DeferredResult(previous) for dn in wave]
+        state = {'pending' : len(previous), 'error' : None}
+
+        def completed(error=None):
+            if state['error'] is None:
+                state['error'] = error
+            state['pending'] -= 1
+            if state['pending'] > 0:
+                return
+            for dn, handle in zip(wave, handles):
+                if state['error'] is not None:
+                    handle._fail(state['error'])
+                else:
+                    handle._issue(lambda: self.__delete_async(dn))
+
+        for handle in previous:
+            handle.add_callback(lambda result: completed(), completed)
+        return handles
     
 
 #
@@ -0,0 +1,433 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## This file is part of LDAPAlchemy
+## Copyright (C) 2007 Cleber Rodrigues <cleber.gnu@gmail.com>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rodrigues <cleber.gnu@gmail.com>
+##
+'''
+filters.py
+
+   Provides a expression language for building search filters
+
+   This is something like the "where clause" constructs in SQLAlchemy:
+
+   >>> t.c.uid == 'john'
+   >>> and_(t.c.cn.startswith('Jo'), not_(t.c.mail.present()))
+   >>> (t.c.uidNumber >= 1000) | (t.c.gidNumber == 100)
+
+   Filters compile to RFC 4515 strings, with values properly escaped.
+'''
+
+__all__ = ['and_', 'or_', 'not_', 'present', 'escape', 'compile_filter',
+           'FilterElement', 'Attribute', 'AttributeCollection']
+
+#
+# Characters that must be escaped in filter values, as per RFC 4515.
+# The backslash must come first
+#
+FILTER_ESCAPES = (('\\', r'\5c'),
+                  ('*', r'\2a'),
+                  ('(', r'\28'),
+                  (')', r'\29'),
+                  ('\x00', r'\00'))
+
+#
+# Compiled filter skeletons, keyed by the shape of the filter
+#
+SKELETON_CACHE_SIZE = 1000
+_skeleton_cache = {}
+
+def escape(value):
+    '''
+    Escapes a value so it can be safely used in a filter
+    '''
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+
+    for char, escaped in FILTER_ESCAPES:
+        if char in value:
+            value = value.replace(char, escaped)
+    return value
+
+def _get_values(entry, name):
+    '''
+    Returns the values of the named attribute in entry (a dict), looking
+    up the attribute name case insensitively
+    '''
+    values = entry.get(name)
+    if values is not None:
+        return values
+    name = name.lower()
+    for key, values in entry.items():
+        if key.lower() == name:
+            return values
+    return []
+
+def _normalize_value(value):
+    '''
+    Returns value in a form suitable for comparisons. Numbers compare as
+    such, everything else compares case insensitively
+    '''
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+    try:
+        return int(value)
+    except ValueError:
+        return ' '.join(value.lower().split())
+
+def compile_filter(element):
+    '''
+    Returns the filter string for the given filter element
+
+    The filter "skeleton" (everything but the values) only depends on the
+    shape of the filter, so it is built once and cached. Compiling the same
+    kind of filter with different values only costs a value substitution.
+    '''
+    shape = element._shape()
+    skeleton = _skeleton_cache.get(shape)
+    if skeleton is None:
+        if len(_skeleton_cache) >= SKELETON_CACHE_SIZE:
+            _skeleton_cache.clear()
+        skeleton = element._skeleton()
+        _skeleton_cache[shape] = skeleton
+
+    values = []
+    element._collect_values(values)
+    return skeleton % tuple(values)
+
+class FilterElement(object):
+    '''
+    Base class for all filter elements
+
+    Elements can be combined with the &, | and ~ operators
+    '''
+    def __and__(self, other):
+        return and_(self, other)
+
+    def __or__(self, other):
+        return or_(self, other)
+
+    def __invert__(self):
+        return not_(self)
+
+    def _shape(self):
+        '''
+        Returns a hashable description of this element, without its values
+        '''
+        raise NotImplementedError
+
+    def _skeleton(self):
+        '''
+        Returns the filter string with "%s" in place of each value
+        '''
+        raise NotImplementedError
+
+    def _collect_values(self, values):
+        '''
+        Appends the escaped values of this element, in order, to values
+        '''
+        pass
+
+    def match(self, entry):
+        '''
+        Returns True if entry (a dict of attribute values) matches this
+        filter element
+
+        This approximates the server side evaluation, assuming case
+        insensitive matching rules, so that filters can be evaluated
+        against entries held in memory
+        '''
+        raise NotImplementedError
+
+    def compile(self):
+        return compile_filter(self)
+
+    __str__ = compile
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.compile())
+
+class Comparison(FilterElement):
+    '''
+    A (name<operator>value) filter item, such as equality or ordering
+    '''
+    def __init__(self, name, operator, value):
+        self.name = name
+        self.operator = operator
+        self.value = value
+
+    def _shape(self):
+        return ('cmp', self.name, self.operator)
+
+    def _skeleton(self):
+        return '(%s%s%%s)' % (self.name, self.operator)
+
+    def _collect_values(self, values):
+        values.append(escape(self.value))
+
+    def match(self, entry):
+        wanted = _normalize_value(self.value)
+        for value in _get_values(entry, self.name):
+            value = _normalize_value(value)
+            other = wanted
+            if type(value) != type(other):
+                value, other = str(value), str(other)
+            if self.operator in ('=', '~='):
+                if value == other:
+                    return True
+            elif self.operator == '>=':
+                if value >= other:
+                    return True
+            elif self.operator == '<=':
+                if value <= other:
+                    return True
+        return False
+
+class Substring(FilterElement):
+    '''
+    A substring filter item, such as (cn=Jo*)
+
+    kind is one of 'initial', 'final' or 'any'
+    '''
+    SKELETONS = {'initial' : '(%s=%%s*)',
+                 'final' : '(%s=*%%s)',
+                 'any' : '(%s=*%%s*)'}
+
+    def __init__(self, name, kind, value):
+        self.name = name
+        self.kind = kind
+        self.value = value
+
+    def _shape(self):
+        return ('sub', self.name, self.kind)
+
+    def _skeleton(self):
+        return self.SKELETONS[self.kind] % self.name
+
+    def _collect_values(self, values):
+        values.append(escape(self.value))
+
+    def match(self, entry):
+        wanted = str(_normalize_value(self.value))
+        for value in _get_values(entry, self.name):
+            value = str(_normalize_value(value))
+            if self.kind == 'initial' and value.startswith(wanted):
+                return True
+            if self.kind == 'final' and value.endswith(wanted):
+                return True
+            if self.kind == 'any' and wanted in value:
+                return True
+        return False
+
+class Present(FilterElement):
+    '''
+    A presence filter item, such as (mail=*)
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def _shape(self):
+        return ('pres', self.name)
+
+    def _skeleton(self):
+        return '(%s=*)' % self.name
+
+    def match(self, entry):
+        return len(_get_values(entry, self.name)) > 0
+
+class BooleanClause(FilterElement):
+    '''
+    A "&" or "|" of other filter elements
+    '''
+    def __init__(self, operator, clauses):
+        self.operator = operator
+        self.clauses = clauses
+
+    def _shape(self):
+        return (self.operator, tuple([c._shape() for c in self.clauses]))
+
+    def _skeleton(self):
+        return '(%s%s)' % (self.operator,
+                           ''.join([c._skeleton() for c in self.clauses]))
+
+    def _collect_values(self, values):
+        for clause in self.clauses:
+            clause._collect_values(values)
+
+    def match(self, entry):
+        if self.operator == '&':
+            for clause in self.clauses:
+                if not clause.match(entry):
+                    return False
+            return True
+        for clause in self.clauses:
+            if clause.match(entry):
+                return True
+        return False
+
+class Not(FilterElement):
+    '''
+    The negation of a filter element
+    '''
+    def __init__(self, clause):
+        self.clause = clause
+
+    def _shape(self):
+        return ('!', self.clause._shape())
+
+    def _skeleton(self):
+        return '(!%s)' % self.clause._skeleton()
+
+    def _collect_values(self, values):
+        self.clause._collect_values(values)
+
+    def match(self, entry):
+        return not self.clause.match(entry)
+
+def and_(*clauses):
+    '''
+    Returns a filter that matches when all the given clauses match
+    '''
+    return BooleanClause('&', list(clauses))
+
+def or_(*clauses):
+    '''
+    Returns a filter that matches when any of the given clauses match
+    '''
+    return BooleanClause('|', list(clauses))
+
+def not_(clause):
+    '''
+    Returns a filter that matches when the given clause does not match
+    '''
+    return Not(clause)
+
+def present(name):
+    '''
+    Returns a filter that matches entries that have the given attribute
+    '''
+    return Present(name)
+
+class Attribute(object):
+    '''
+    Represents a attribute in filter expressions
+
+    This is something like "Column" in SQLAlchemy: its operators return
+    filter elements instead of booleans
+
+    codec, if given, converts values that are not strings (numbers,
+    booleans, dates...) to the strings the server expects, see
+    ldapalchemy.syntaxes
+    '''
+    def __init__(self, name, codec=None):
+        self.name = name
+        self.codec = codec
+
+    def _encode(self, value):
+        if self.codec is None or isinstance(value, basestring):
+            return value
+        return self.codec.encode(value)
+
+    def __eq__(self, other):
+        if other is None:
+            return not_(Present(self.name))
+        return Comparison(self.name, '=', self._encode(other))
+
+    def __ne__(self, other):
+        if other is None:
+            return Present(self.name)
+        return not_(Comparison(self.name, '=', self._encode(other)))
+
+    def __ge__(self, other):
+        return Comparison(self.name, '>=', self._encode(other))
+
+    def __le__(self, other):
+        return Comparison(self.name, '<=', self._encode(other))
+
+    #
+    # LDAP has no strict ordering matches, so build them from the others.
+    # (!(a<=v)) would also match entries without the attribute, and on
+    # multi valued attributes it would mean "no value <= v"
+    #
+    def __gt__(self, other):
+        value = self._encode(other)
+        return and_(Comparison(self.name, '>=', value),
+                    not_(Comparison(self.name, '=', value)))
+
+    def __lt__(self, other):
+        value = self._encode(other)
+        return and_(Comparison(self.name, '<=', value),
+                    not_(Comparison(self.name, '=', value)))
+
+    def approx(self, other):
+        return Comparison(self.name, '~=', self._encode(other))
+
+    def startswith(self, other):
+        return Substring(self.name, 'initial', self._encode(other))
+
+    def endswith(self, other):
+        return Substring(self.name, 'final', self._encode(other))
+
+    def contains(self, other):
+        return Substring(self.name, 'any', self._encode(other))
+
+    def present(self):
+        return Present(self.name)
+
+    def in_(self, values):
+        return or_(*[Comparison(self.name, '=', self._encode(v))
+                     for v in values])
+
+    def __repr__(self):
+        return '<Attribute %s>' % self.name
+
+class AttributeCollection(object):
+    '''
+    Gives access to the attributes of a template, as in "template.c.uid"
+    '''
+    def __init__(self, template):
+        self._template = template
+        self._attributes = {}
+
+    def __getitem__(self, name):
+        key = name.lower()
+        if not self._attributes.has_key(key):
+            for attribute_name in self._template.attribute_names:
+                if attribute_name.lower() == key:
+                    break
+            else:
+                raise KeyError, name
+            codec = self._template.codecs.get(name)
+            self._attributes[key] = Attribute(name, codec)
+        return self._attributes[key]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError, name
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError, name
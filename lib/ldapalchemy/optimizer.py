@@ -0,0 +1,213 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## This file is part of LDAPAlchemy
+## Copyright (C) 2007 Cleber Rodrigues <cleber.gnu@gmail.com>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rodrigues <cleber.gnu@gmail.com>
+##
+'''
+optimizer.py
+
+   Provides a schema aware optimizer for search filters
+'''
+
+__all__ = ['FilterOptimizer']
+
+from ldapalchemy.config import DefaultConfig
+from ldapalchemy.filters import BooleanClause, Not, Comparison
+from ldapalchemy.schema import ElementNotFoundError
+
+class FilterOptimizer(object):
+    '''
+    Rewrites filters so that they are cheaper for the server to evaluate
+
+    The following rewrites are done:
+
+       * nested "&" and "|" are flattened, and single clause ones removed
+       * double negations are removed
+       * duplicated terms are removed
+       * objectClass terms implied by others are removed, that is, in
+         (&(objectClass=top)(objectClass=person)(objectClass=inetOrgPerson))
+         only inetOrgPerson is kept, since the schema says it is a person
+         and every person is a top
+       * terms of "&" are ordered so that the ones on indexed attributes
+         come first, in the order of the indexed attributes list
+
+    The indexed attributes list defaults to the one in the configuration.
+    '''
+    def __init__(self, schema=None, indexed_attributes=None):
+        if indexed_attributes is None:
+            indexed_attributes = DefaultConfig.search_indexed_attributes
+
+        self.schema = schema
+        self.indexed_attributes = [a.lower() for a in indexed_attributes]
+
+        self.__sup_names = {}
+
+    def optimize(self, element):
+        '''
+        Returns the optimized version of the given filter element
+        '''
+        return self.__optimize(element, [])
+
+    def explain(self, element):
+        '''
+        Returns a human readable report on how the given filter element is
+        rewritten, and which of its terms hit indexed attributes
+        '''
+        notes = []
+        optimized = self.__optimize(element, notes)
+
+        lines = ['Original:  %s' % element.compile(),
+                 'Optimized: %s' % optimized.compile(),
+                 'Terms:']
+        for term in self.__terms(optimized):
+            if self.__index_rank(term) < len(self.indexed_attributes):
+                status = 'indexed'
+            else:
+                status = 'NOT indexed'
+            lines.append('   %-40s %s' % (term.compile(), status))
+
+        if notes:
+            lines.append('Rewrites:')
+            for note in notes:
+                lines.append('   %s' % note)
+
+        return '\n'.join(lines)
+
+    #
+    # Internal Methods
+    #
+    def __optimize(self, element, notes):
+        if isinstance(element, Not):
+            clause = self.__optimize(element.clause, notes)
+            if isinstance(clause, Not):
+                notes.append('removed double negation of %s' %
+                             clause.clause.compile())
+                return clause.clause
+            return Not(clause)
+
+        if not isinstance(element, BooleanClause):
+            return element
+
+        clauses = []
+        for clause in element.clauses:
+            clause = self.__optimize(clause, notes)
+            if isinstance(clause, BooleanClause) and \
+                    clause.operator == element.operator:
+                clauses += clause.clauses
+            else:
+                clauses.append(clause)
+
+        clauses = self.__remove_duplicates(clauses, notes)
+
+        if element.operator == '&':
+            clauses = self.__remove_implied_ocs(clauses, notes)
+            clauses = self.__sort_by_index(clauses)
+
+        if len(clauses) == 1:
+            return clauses[0]
+        return BooleanClause(element.operator, clauses)
+
+    def __key(self, element):
+        values = []
+        element._collect_values(values)
+        return (element._shape(), tuple(values))
+
+    def __remove_duplicates(self, clauses, notes):
+        seen = {}
+        result = []
+        for clause in clauses:
+            key = self.__key(clause)
+            if seen.has_key(key):
+                notes.append('removed duplicate %s' % clause.compile())
+                continue
+            seen[key] = True
+            result.append(clause)
+        return result
+
+    def __is_oc_term(self, element):
+        return isinstance(element, Comparison) and \
+            element.operator == '=' and \
+            element.name.lower() == 'objectclass'
+
+    def __get_sup_names(self, name):
+        '''
+        Returns the (lower case) names of all superior classes of name
+        '''
+        key = name.lower()
+        if not self.__sup_names.has_key(key):
+            try:
+                sups = self.schema.oc_get_all_sup_by_name(name)
+            except ElementNotFoundError:
+                sups = []
+            self.__sup_names[key] = [s.lower() for s in sups]
+        return self.__sup_names[key]
+
+    def __remove_implied_ocs(self, clauses, notes):
+        if self.schema is None:
+            return clauses
+
+        oc_names = [str(c.value) for c in clauses if self.__is_oc_term(c)]
+        implied = {}
+        for name in oc_names:
+            for sup_name in self.__get_sup_names(name):
+                implied[sup_name] = name
+
+        result = []
+        for clause in clauses:
+            if self.__is_oc_term(clause):
+                value = str(clause.value).lower()
+                if implied.has_key(value):
+                    notes.append('removed %s, implied by %s' %
+                                 (clause.compile(), implied[value]))
+                    continue
+            result.append(clause)
+        return result
+
+    def __index_rank(self, element):
+        '''
+        Returns the position of the element's attribute in the indexed
+        attributes list, or the list length for unindexed attributes
+        '''
+        name = getattr(element, 'name', None)
+        if name is not None and name.lower() in self.indexed_attributes:
+            return self.indexed_attributes.index(name.lower())
+        return len(self.indexed_attributes)
+
+    def __sort_by_index(self, clauses):
+        decorated = [(self.__index_rank(c), n, c) \
+                         for n, c in enumerate(clauses)]
+        decorated.sort()
+        return [d[2] for d in decorated]
+
+    def __terms(self, element):
+        '''
+        Returns all the leaf terms of the given filter element
+        '''
+        if isinstance(element, BooleanClause):
+            terms = []
+            for clause in element.clauses:
+                terms += self.__terms(clause)
+            return terms
+        if isinstance(element, Not):
+            return self.__terms(element.clause)
+        return [element]
@@ -0,0 +1,236 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## This file is part of LDAPAlchemy
+## Copyright (C) 2007 Cleber Rodrigues <cleber.gnu@gmail.com>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rodrigues <cleber.gnu@gmail.com>
+##
+'''
+pool.py
+
+   Provides a pool of LDAP connections
+'''
+
+__all__ = ['ConnectionPool']
+
+import time
+import Queue
+import threading
+
+import ldap
+
+from ldapalchemy.exceptions import PoolTimeout
+
+class _ConnectionRecord:
+    '''
+    Keeps track of a connection handled by the pool
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = time.time()
+        self.last_used = self.created
+        self.invalidated = False
+
+    def close(self):
+        '''
+        Unbinds the connection, ignoring errors from already dead ones
+        '''
+        try:
+            self.connection.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+class ConnectionPool:
+    '''
+    A pool of bound LDAP connections
+
+    This is modeled after SQLAlchemy's QueuePool: up to `pool_size`
+    connections are kept around, and up to `max_overflow` extra ones can be
+    opened when the pool is exhausted. These extra connections are closed
+    when they are checked back in. Setting `max_overflow` to -1 disables the
+    overflow limit.
+
+    Connections are validated on checkout: those older than `recycle`
+    seconds are replaced, and those that have been sitting idle for more
+    than `ping_interval` seconds are probed with a root DSE read before
+    being handed out. Dead connections are transparently replaced.
+    '''
+    def __init__(self, creator, pool_size=5, max_overflow=10, timeout=30,
+                 recycle=-1, ping_interval=10):
+        '''
+        Creates a new pool. `creator` is a callable that returns a new,
+        already bound, connection
+        '''
+        self._creator = creator
+        self._pool = Queue.Queue(pool_size)
+        self._pool_size = pool_size
+        self._overflow = 0 - pool_size
+        self._max_overflow = max_overflow
+        self._timeout = timeout
+        self._recycle = recycle
+        self._ping_interval = ping_interval
+
+        self._overflow_lock = threading.Lock()
+        self._checked_out = {}
+
+    def checkout(self):
+        '''
+        Returns a validated connection from the pool
+        '''
+        while True:
+            record = self.__get_record()
+            if self.__is_usable(record):
+                break
+            self.__discard(record)
+
+        self._checked_out[id(record.connection)] = record
+        return record.connection
+
+    def checkin(self, connection):
+        '''
+        Returns a connection to the pool
+        '''
+        record = self._checked_out.pop(id(connection))
+        if record.invalidated:
+            self.__discard(record)
+            return
+
+        record.last_used = time.time()
+        try:
+            self._pool.put(record, False)
+        except Queue.Full:
+            self.__discard(record)
+
+    def invalidate(self, connection):
+        '''
+        Marks a checked out connection as dead
+
+        It will be closed, and not reused, when it gets checked in.
+        '''
+        record = self._checked_out.get(id(connection))
+        if record is not None:
+            record.invalidated = True
+
+    def dispose(self):
+        '''
+        Closes all connections that are idle in the pool
+        '''
+        while True:
+            try:
+                record = self._pool.get(False)
+            except Queue.Empty:
+                break
+            self.__discard(record)
+
+    def size(self):
+        return self._pool_size
+
+    def checkedin(self):
+        return self._pool.qsize()
+
+    def checkedout(self):
+        return len(self._checked_out)
+
+    def overflow(self):
+        return self._overflow
+
+    def status(self):
+        '''
+        Returns a human readable description of the pool state
+        '''
+        return ("Pool size: %d  Connections in pool: %d  "
+                "Current Overflow: %d  Current Checked out connections: %d" %
+                (self.size(), self.checkedin(), self.overflow(),
+                 self.checkedout()))
+
+    #
+    # Internal Methods
+    #
+    def __get_record(self):
+        '''
+        Gets a record from the queue, or creates a new connection if the
+        overflow limit allows it
+        '''
+        use_overflow = self._max_overflow > -1
+
+        wait = use_overflow and self._overflow >= self._max_overflow
+        try:
+            return self._pool.get(wait, self._timeout)
+        except Queue.Empty:
+            pass
+
+        if use_overflow and self._overflow >= self._max_overflow:
+            if not wait:
+                return self.__get_record()
+            raise PoolTimeout, ("Pool limit of size %d overflow %d reached, "
+                                "connection timed out, timeout %d" %
+                                (self._pool_size, self._max_overflow,
+                                 self._timeout))
+
+        self._overflow_lock.acquire()
+        try:
+            if use_overflow and self._overflow >= self._max_overflow:
+                retry = True
+            else:
+                self._overflow += 1
+                retry = False
+        finally:
+            self._overflow_lock.release()
+
+        if retry:
+            return self.__get_record()
+
+        try:
+            return _ConnectionRecord(self._creator())
+        except:
+            self.__dec_overflow()
+            raise
+
+    def __is_usable(self, record):
+        '''
+        Returns True if the connection in the record can be handed out
+        '''
+        now = time.time()
+        if self._recycle > -1 and now - record.created > self._recycle:
+            return False
+
+        if now - record.last_used > self._ping_interval:
+            try:
+                record.connection.search_s('', ldap.SCOPE_BASE,
+                                           '(objectClass=*)', ['1.1'])
+            except ldap.LDAPError:
+                return False
+
+        return True
+
+    def __discard(self, record):
+        '''
+        Closes the record's connection and gives back its overflow slot
+        '''
+        record.close()
+        self.__dec_overflow()
+
+    def __dec_overflow(self):
+        self._overflow_lock.acquire()
+        try:
+            self._overflow -= 1
+        finally:
+            self._overflow_lock.release()
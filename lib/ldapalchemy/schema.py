@@ -35,6 +35,8 @@ __all__ = ['Schema', 'SchemaCache', 'MetaData', 'OC_NAME', 'AT_NAME',
 import re
 import ldap
 import ldif
+import weakref
+import threading
 
 from ldapalchemy.config import DefaultConfig
 from ldapalchemy.engine import Engine
@@ -94,6 +96,11 @@ GET_ELEMENT_NAMES_RE = re.compile(r'^\(\s[\w\.-]+\sNAME\s\(\s(.*?)\s\)')
  SourceLdapServer,
  SourceExternalFile) = range(3)
 
+#
+# Positions in the nodes of the LRU list of SchemaWeakCache
+#
+(PREV, NEXT, KEY, VALUE) = range(4)
+
 class SchemaLDIFParser(ldif.LDIFParser):
     '''
     Parses a LDIF containing schema information
@@ -147,11 +154,11 @@ class SchemaEngineParser:
         self.load_schema()
         
     def load_schema(self):
-        self.schema_dn = self.engine._connection.search_subschemasubentry_s()
+        self.schema_dn = self.engine._call('search_subschemasubentry_s')
         if self.schema_dn:
-            self.schema_dict = self.engine._connection.\
-                read_subschemasubentry_s(self.schema_dn,
-                                         ElementTypes)
+            self.schema_dict = self.engine._call('read_subschemasubentry_s',
+                                                 self.schema_dn,
+                                                 ElementTypes)
 
 class SchemaNonCache:
     def __init__(self, source):
@@ -171,9 +178,15 @@ class SchemaNonCache:
            * SourceNowhere: It's not loaded yet.
            * SourceLdapServer: Comes from a LDAP server
            * SourceExternalFile: Comes from a external LDIF file
+
+        Elements are indexed by OID and by all their names (case
+        insensitively) in a single pass over the schema, so finding a
+        element is a dict lookup. The indexes are rebuilt if schema_parser
+        is replaced.
         '''
         self.schema_parser = None
         self.schema_source = SourceNowhere
+        self._indexed_parser = None
 
         self.load(source)
 
@@ -195,6 +208,52 @@ class SchemaNonCache:
         else:
             raise SchemaSourceTypeUknownError
 
+        self.__build_indexes()
+
+    def __build_indexes(self):
+        '''
+        Indexes all elements of the schema by OID and by name, parsing
+        each element only once
+        '''
+        schema_dict = getattr(self.schema_parser, 'schema_dict', None) or {}
+
+        self._element_names = {}
+        self._by_oid = {}
+        self._by_name = {}
+        self._oids = {}
+        self._names = {}
+
+        for element_type in ElementTypes:
+            by_oid = self._by_oid[element_type] = {}
+            by_name = self._by_name[element_type] = {}
+            oids = self._oids[element_type] = []
+            all_names = self._names[element_type] = []
+
+            for element in schema_dict.get(element_type, []):
+                match = GET_ELEMENT_OID_RE.match(element)
+                if match:
+                    oid = match.groups()[0]
+                    oids.append(oid)
+                    by_oid.setdefault(oid, element)
+
+                if self.__element_has_many_names(element):
+                    names = self.__get_element_names(element)
+                else:
+                    names = [self.__get_element_name(element)]
+                self._element_names[element] = names
+
+                for name in names:
+                    all_names.append(name)
+                    if name is not None:
+                        by_name.setdefault(name.lower(), element)
+
+        self._indexed_parser = self.schema_parser
+
+    def __get_index(self, index, element_type):
+        if self._indexed_parser is not self.schema_parser:
+            self.__build_indexes()
+        return getattr(self, index)[element_type]
+
     def get_element_oid(self, element):
         '''
         Returns the OID of a element
@@ -211,6 +270,10 @@ class SchemaNonCache:
         The result might be a list containing a single item if
         the element has a single name.
         '''
+        names = self._element_names.get(element)
+        if names is not None:
+            return list(names)
+
         many_names = self.__element_has_many_names(element)
         if many_names:
             return self.__get_element_names(element)
@@ -228,10 +291,10 @@ class SchemaNonCache:
         '''
         Returns the element that has the given OID
         '''
-        for element in self.schema_parser.schema_dict[element_type]:
-            if self.get_element_oid(element) == element_oid:
-                return element
-        raise ElementNotFoundError
+        element = self.__get_index('_by_oid', element_type).get(element_oid)
+        if element is None:
+            raise ElementNotFoundError
+        return element
 
     def get_element_obj_by_oid(self, element_oid, element_type):
         '''
@@ -243,12 +306,14 @@ class SchemaNonCache:
 
     def get_element_by_name(self, element_name, element_type):
         '''
-        Returns the element that has the given element name
+        Returns the element that has the given element name, which is
+        case insensitive
         '''
-        for element in self.schema_parser.schema_dict[element_type]:
-            if element_name in self.get_element_names(element):
-                return element
-        raise ElementNotFoundError
+        by_name = self.__get_index('_by_name', element_type)
+        element = by_name.get(element_name.lower())
+        if element is None:
+            raise ElementNotFoundError
+        return element
 
     def get_element_obj_by_name(self, element_name, element_type):
         '''
@@ -263,21 +328,13 @@ class SchemaNonCache:
         '''
         Returns all the element oid in this schema
         '''
-        result = []
-        for element in self.schema_parser.schema_dict[element_type]:
-            result.append(self.get_element_oid(element))
-        return result
+        return list(self.__get_index('_oids', element_type))
 
     def get_all_element_names(self, element_type):
         '''
         Returns all names of the element
         '''
-        result = []
-        for element in self.schema_parser.schema_dict[element_type]:
-            element_names = self.get_element_names(element)
-            for element_name in element_names:
-                result.append(element_name)
-        return result
+        return list(self.__get_index('_names', element_type))
 
     #
     # Helper methods for Object Classes 
@@ -431,128 +488,166 @@ class SchemaCacheBase(SchemaNonCache):
     
     This is a base class, use either SchemaStrongCache or SchemaWeakCache.
     DONT USE THIS DIRECTLY. 
-    '''
-    pass
-
-class SchemaWeakCache(SchemaCacheBase):
-    '''
-    Improves a Schema by adding a cache for quickly returning entries
-    already accessed
-
-    Two WeakKeyDictionary implement these caches:
-
-    * __element_by_name
-    * __element_by_oid
-
-    '''
-    pass
 
-class SchemaStrongCache(SchemaCacheBase):
-    '''
-    Improves Schema by adding a cache for quickly returning entries 
-    already accessed
-
-    Two dicts implement these caches:
-
-       * __element_by_name
-       * __element_by_oid
-
-    SchemaCache sets up these dict to provide faster get_* methods
-    
+    Finding the raw element is already a dict lookup (see SchemaNonCache),
+    so only the element objects, which are expensive to parse, are cached.
+    They are kept in a dict keyed by (element_type, element), through
+    _get_cached() and _put_cached(), which subclasses may override to
+    bound the cache.
     '''
     def __init__(self, source):
-        SchemaCacheBase.__init__(self, source)
+        self._element_obj = {}
+        SchemaNonCache.__init__(self, source)
 
-        self.__element_by_name = {}
-        self.__element_by_oid = {}
-        self.__element_obj_by_name = {}
-        self.__element_obj_by_oid = {}
+    def get_element_obj_by_oid(self, element_oid, element_type):
+        element = self.get_element_by_oid(element_oid, element_type)
+        return self.__get_element_obj(element, element_type)
 
-        for element_type in ElementTypes:
-            self.__element_by_name[element_type] = {}
-            self.__element_by_oid[element_type] = {}
-            self.__element_obj_by_name[element_type] = {}
-            self.__element_obj_by_oid[element_type] = {}
+    def get_element_obj_by_name(self, element_name, element_type):
+        element = self.get_element_by_name(element_name, element_type)
+        return self.__get_element_obj(element, element_type)
 
-    def get_element_by_oid(self, element_oid, element_type):
-        if self.__element_by_oid[element_type].has_key(element_oid):
-            return self.__element_by_oid[element_type][element_oid]
+    def __get_element_obj(self, element, element_type):
+        key = (element_type, element)
+        obj = self._get_cached(key)
+        if obj is None:
+            obj = ElementClasses[element_type](element)
+            self._put_cached(key, obj)
+        return obj
 
-        element = SchemaCacheBase.get_element_by_oid(self, 
-                                            element_oid, 
-                                            element_type)
-        if element:
-            self.__element_by_oid[element_type][element_oid] = element
-            return element
+    def _get_cached(self, key):
+        return self._element_obj.get(key)
 
-    def get_element_obj_by_oid(self, element_oid, element_type):
-        if self.__element_obj_by_oid[element_type].has_key(element_oid):
-            return self.__element_obj_by_oid[element_type][element_oid]
+    def _put_cached(self, key, obj):
+        self._element_obj[key] = obj
 
-        element = SchemaCacheBase.get_element_obj_by_oid(self, 
-                                                element_oid, 
-                                                element_type)
-        if element:
-            self.__element_obj_by_oid[element_type][element_oid] = element
-            return element
+class SchemaWeakCache(SchemaCacheBase):
+    '''
+    Improves a Schema by adding a cache for quickly returning entries
+    already accessed, with bounded memory use
 
-    def get_element_by_name(self, element_name, element_type):
-        if self.__element_by_name[element_type].has_key(element_name):
-            return self.__element_by_name[element_type][element_name]
-        
-        element = SchemaCacheBase.get_element_by_name(self, 
-                                             element_name, 
-                                             element_type)
-        if element:
-            self.__element_by_name[element_type][element_name] = element
-            return element
+    Up to size element objects, the most recently used ones, are kept
+    alive by the cache itself, in a LRU list. Older ones are only kept
+    in a WeakValueDictionary, so they are still found while they are in
+    use elsewhere (eg, by a Template), and freed otherwise.
 
-    def get_element_obj_by_name(self, element_oid, element_type):
-        if self.__element_obj_by_name[element_type].has_key(element_oid):
-            return self.__element_obj_by_name[element_type][element_oid]
+    The hits, weak_hits (found only through a weak reference), misses
+    and evictions counters help sizing the cache.
+    '''
+    def __init__(self, source, size=None):
+        if size is None:
+            size = DefaultConfig.schema_cache_size
+        self.size = size
 
-        element = SchemaCacheBase.get_element_obj_by_name(self, 
-                                                 element_oid, 
-                                                 element_type)
-        if element:
-            self.__element_obj_by_name[element_type][element_oid] = element
-            return element
+        self._lock = threading.Lock()
+        self.clear()
 
-    def __load_all_element_oids(self, element_type):
-        '''
-        Loads all element OIDs
+        SchemaCacheBase.__init__(self, source)
 
-        Fetches all OIDs, and then tries to "get" them all. This "get"
-        action implemented in this class (SchemaCache), tries to fetch 
-        it from the cache, and if not found, from the underlying class
-        (Schema).
-        '''
-        oids = SchemaCacheBase.get_all_element_oids(self, element_type)
-        for oid in oids:
-            self.get_element_by_oid(oid, element_type)
+    def clear(self):
+        '''
+        Drops all cached element objects and resets the counters
+        '''
+        self._lock.acquire()
+        try:
+            self._nodes = {}
+            self._weak = weakref.WeakValueDictionary()
+
+            #
+            # Circular doubly linked list, most recently used at the head
+            #
+            self._root = root = []
+            root[:] = [root, root, None, None]
+
+            self.hits = 0
+            self.weak_hits = 0
+            self.misses = 0
+            self.evictions = 0
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        '''
+        Returns a dict with the cache counters and current usage
+        '''
+        return {'hits' : self.hits,
+                'weak_hits' : self.weak_hits,
+                'misses' : self.misses,
+                'evictions' : self.evictions,
+                'cached' : len(self._nodes),
+                'alive' : len(self._weak)}
+
+    def _get_cached(self, key):
+        self._lock.acquire()
+        try:
+            node = self._nodes.get(key)
+            if node is not None:
+                self.__unlink(node)
+                self.__link(node)
+                self.hits += 1
+                return node[VALUE]
+
+            obj = self._weak.get(key)
+            if obj is None:
+                self.misses += 1
+                return None
+
+            self.weak_hits += 1
+            self.__insert(key, obj)
+            return obj
+        finally:
+            self._lock.release()
+
+    def _put_cached(self, key, obj):
+        self._lock.acquire()
+        try:
+            self._weak[key] = obj
+            if not self._nodes.has_key(key):
+                self.__insert(key, obj)
+        finally:
+            self._lock.release()
 
-    def get_all_element_oids(self, element_type):
-        self.__load_all_element_oids(element_type)
-        return self.__element_by_oid[element_type].keys()
-        
-    def __load_all_element_names(self, element_type):
-        '''
-        Loads all element names
+    #
+    # Internal Methods. These expect the lock to be held
+    #
+    def __insert(self, key, obj):
+        node = [None, None, key, obj]
+        self.__link(node)
+        self._nodes[key] = node
+
+        while len(self._nodes) > self.size:
+            node = self._root[PREV]
+            self.__unlink(node)
+            del self._nodes[node[KEY]]
+            self.evictions += 1
+
+    def __link(self, node):
+        root = self._root
+        first = root[NEXT]
+        node[PREV] = root
+        node[NEXT] = first
+        first[PREV] = node
+        root[NEXT] = node
+
+    def __unlink(self, node):
+        node[PREV][NEXT] = node[NEXT]
+        node[NEXT][PREV] = node[PREV]
 
-        Implements the same logic as __load_all_element_oids
-        '''
-        names = SchemaCacheBase.get_all_element_names(self, element_type)
-        for name in names:
-            self.get_element_by_name(name, element_type)
+class SchemaStrongCache(SchemaCacheBase):
+    '''
+    Improves Schema by adding a cache for quickly returning entries 
+    already accessed
 
-    def get_all_element_names(self, element_type):
-        self.__load_all_element_names(element_type)
-        return self.__element_by_name[element_type].keys()
+    Every element object parsed is kept for the life of the schema, in
+    the dict held by SchemaCacheBase. Use SchemaWeakCache to bound memory
+    use.
+    '''
 
 #
-# The chosen Schema type is SchemaStrongCache (because Weak is not implemented yet)
+# The chosen Schema type is SchemaWeakCache, so memory use is bounded in
+# processes dealing with many (or big) schemas
 #
-Schema = SchemaStrongCache
+Schema = SchemaWeakCache
 
 #
 # SQLALchemy Compatibilty: MetaData is really a Schema
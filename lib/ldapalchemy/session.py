@@ -29,18 +29,349 @@ session.py
    Provides session classes
 '''
 
-__all__ == ['Session']
+__all__ = ['Session']
 
+import ldap
+import ldap.dn
+
+from ldapalchemy.entry import Entry
+from ldapalchemy.expression import pipeline
+from ldapalchemy.exceptions import SessionInvalidChange
+from ldapalchemy.util import normalize_dn
+
+#
+# Default for the attrlist argument of merge(), as None means all attributes
+#
+_NOT_GIVEN = object()
+
+class PendingChange:
+    '''
+    The changes recorded in a session for a single entry
+
+    delete tells that the entry must be deleted. attributes, when not
+    None, holds the attributes of the entry to add (after the delete, if
+    any). changes holds the attributes to replace in an existing entry,
+    with None values for the ones to remove.
+    '''
+    def __init__(self, dn):
+        self.dn = dn
+        self.delete = False
+        self.attributes = None
+        self.changes = {}
+
+    def is_empty(self):
+        return not self.delete and self.attributes is None and \
+            not self.changes
 
 class Session:
-    def __init__(self, engine):
+    def __init__(self, engine, window=100):
         '''
-        Implements a session. Basis of Unit of Work 
+        Implements a session. Basis of Unit of Work
+
+        Changes are only recorded by add(), delete() and modify(), and
+        sent to the server on commit(). Changes to the same entry are
+        coalesced: a add followed by modifies is sent as a single add,
+        several modifies as a single modify, and a add followed by a
+        delete is not sent at all.
+
+        window is the maximum number of requests outstanding at any time
+        during a commit.
+
+        Entries loaded through get() are kept in a identity map, keyed by
+        normalized DN, so looking up the same entry again returns the same
+        object without asking the server. Entries changed by commit() are
+        expired from the map.
         '''
         self.engine = engine
+        self.window = window
+        self._pending = {}
+        self._identity_map = {}
+
+    def __get_change(self, dn):
+        key = normalize_dn(dn)
+        change = self._pending.get(key)
+        if change is None:
+            change = PendingChange(dn)
+            self._pending[key] = change
+        return change
+
+    def __values(self, values):
+        if values is None or type(values) == list:
+            return values
+        if type(values) in (tuple, set):
+            return list(values)
+        return [values]
+
+    def add(self, dn, attributes):
+        '''
+        Records the addition of a entry named dn with the given attributes,
+        a dictionary of names to values (single values or lists)
+        '''
+        change = self.__get_change(dn)
+        if change.attributes is not None or change.changes:
+            raise SessionInvalidChange, 'entry %s is already pending' % dn
+
+        change.attributes = {}
+        for name, values in attributes.items():
+            change.attributes[name] = self.__values(values)
+
+    def modify(self, dn, changes):
+        '''
+        Records changes to the entry named dn. changes is a dictionary of
+        attribute names to their new values (single values or lists), or
+        to None for attributes to remove
+        '''
+        change = self.__get_change(dn)
+        if change.attributes is not None:
+            for name, values in changes.items():
+                if values is None:
+                    if change.attributes.has_key(name):
+                        del change.attributes[name]
+                else:
+                    change.attributes[name] = self.__values(values)
+        elif change.delete:
+            raise SessionInvalidChange, 'entry %s is to be deleted' % dn
+        else:
+            for name, values in changes.items():
+                change.changes[name] = self.__values(values)
+
+    def delete(self, dn):
+        '''
+        Records the deletion of the entry named dn
+        '''
+        change = self.__get_change(dn)
+        if change.attributes is not None and not change.delete:
+            #
+            # The entry was never sent to the server
+            #
+            del self._pending[normalize_dn(dn)]
+            return
+
+        change.delete = True
+        change.attributes = None
+        change.changes = {}
+
+    def get(self, dn, attrlist=None):
+        '''
+        Returns the entry named dn, or None if it does not exist
+
+        The entry is only read from the server if it is not in the
+        identity map yet, or if it was loaded without some of the
+        attributes in attrlist. None as attrlist means all attributes.
+        '''
+        key = normalize_dn(dn)
+        loaded = self._identity_map.get(key)
+        if loaded is not None:
+            obj, loaded_attrlist = loaded
+            if self.__covers(loaded_attrlist, attrlist):
+                return obj
+        return self.__load(dn, attrlist)
+
+    def merge(self, obj, dn=None, attrlist=_NOT_GIVEN):
+        '''
+        Puts obj, a entry found by a search (or a object mapped from it),
+        in the identity map under dn, which defaults to obj.dn
+
+        attrlist is the list of attributes obj was searched with, None
+        meaning all. If not given, only the attributes obj has are taken
+        as loaded, so get() reads the entry again when asked for others.
+
+        Returns the object already in the map for that DN if there is one,
+        obj otherwise
+        '''
+        if dn is None:
+            dn = obj.dn
+        if attrlist is _NOT_GIVEN:
+            attributes = getattr(obj, 'attributes', None)
+            if attributes is None:
+                attrlist = None
+            else:
+                attrlist = attributes.keys()
+
+        key = normalize_dn(dn)
+        loaded = self._identity_map.get(key)
+        if loaded is not None:
+            return loaded[0]
+        self._identity_map[key] = (obj, self.__lower(attrlist))
+        return obj
+
+    def expire(self, dn=None):
+        '''
+        Removes the entry named dn from the identity map, so the next get()
+        reads it from the server. Without dn, all entries are removed
+        '''
+        if dn is None:
+            self._identity_map = {}
+        else:
+            self._identity_map.pop(normalize_dn(dn), None)
+
+    def refresh(self, dn, attrlist=None):
+        '''
+        Reads the entry named dn from the server again
+
+        The object in the identity map, if any, is updated in place, so
+        every reference to it sees the new attributes. Returns that object
+        (or a new Entry), or None if the entry no longer exists
+        '''
+        return self.__load(dn, attrlist)
+
+    def pending(self):
+        '''
+        Returns the list of DNs with pending changes
+        '''
+        return [change.dn for change in self._pending.values()]
+
+    def rollback(self):
+        '''
+        Discards all pending changes
+        '''
+        self._pending = {}
 
     def commit(self):
         '''
-        FIXME
+        Sends all pending changes to the server
+
+        Deletes go first, deepest entries first, then adds, shallowest
+        entries first, and modifies last. Changes are sent in waves of
+        entries of the same depth, with all requests of a wave pipelined,
+        so independent subtrees are changed at the same time while parents
+        are always added before (and deleted after) their children.
+
+        If the server refuses a change, the rest of its wave is still
+        sent, but then the first error is raised. Changes already applied
+        are no longer pending, the others are kept for a new commit() or
+        rollback().
+        '''
+        changes = self._pending.values()
+
+        deletes = [c for c in changes if c.delete]
+        for wave in self.__by_depth(deletes, True):
+            self.__flush(wave, 'delete')
+
+        adds = [c for c in changes if c.attributes is not None]
+        for wave in self.__by_depth(adds, False):
+            self.__flush(wave, 'add')
+
+        modifies = [c for c in changes if c.changes]
+        if modifies:
+            self.__flush(modifies, 'modify')
+
+    #
+    # Internal Methods
+    #
+    def __covers(self, loaded_attrlist, attrlist):
+        '''
+        Tells if entries loaded with loaded_attrlist have all the
+        attributes in attrlist
         '''
-        pass
+        if loaded_attrlist is None:
+            return True
+        if attrlist is None:
+            return False
+        for name in attrlist:
+            if name.lower() not in loaded_attrlist:
+                return False
+        return True
+
+    def __load(self, dn, attrlist):
+        key = normalize_dn(dn)
+        try:
+            result = self.engine._call('search_s', dn, ldap.SCOPE_BASE,
+                                       '(objectClass=*)', attrlist)
+        except ldap.NO_SUCH_OBJECT:
+            result = []
+        if not result:
+            self._identity_map.pop(key, None)
+            return None
+
+        dn, attributes = result[0]
+        loaded_attrlist = self.__lower(attrlist)
+
+        loaded = self._identity_map.get(key)
+        if loaded is None or getattr(loaded[0], 'attributes', None) is None:
+            entry = Entry(dn, attributes)
+            self._identity_map[key] = (entry, loaded_attrlist)
+            return entry
+
+        obj, previous_attrlist = loaded
+        self.__update(obj, attributes, loaded_attrlist)
+        if isinstance(obj, Entry):
+            obj.dn = dn
+        if previous_attrlist is not None and loaded_attrlist is not None:
+            loaded_attrlist = previous_attrlist + \
+                [name for name in loaded_attrlist
+                 if name not in previous_attrlist]
+        elif loaded_attrlist is not None:
+            loaded_attrlist = None
+        self._identity_map[key] = (obj, loaded_attrlist)
+        return obj
+
+    def __update(self, obj, attributes, attrlist):
+        '''
+        Replaces in place the values in obj.attributes of the attributes
+        in attrlist (all of them if None) with the ones just read
+        '''
+        current = obj.attributes
+        if attrlist is None:
+            current.clear()
+        else:
+            for name in current.keys():
+                if name.lower() in attrlist:
+                    del current[name]
+        current.update(attributes)
+        if isinstance(obj, Entry):
+            obj._index = None
+
+    def __lower(self, attrlist):
+        if attrlist is None:
+            return None
+        return [name.lower() for name in attrlist]
+
+    def __by_depth(self, changes, deepest_first):
+        '''
+        Groups changes in waves of entries of the same depth
+        '''
+        waves = {}
+        for change in changes:
+            depth = len(ldap.dn.str2dn(change.dn))
+            waves.setdefault(depth, []).append(change)
+
+        depths = waves.keys()
+        depths.sort()
+        if deepest_first:
+            depths.reverse()
+        return [waves[depth] for depth in depths]
+
+    def __request(self, change, kind):
+        if kind == 'delete':
+            return ('delete_ext', (change.dn,))
+        if kind == 'add':
+            return ('add_ext', (change.dn, change.attributes.items()))
+        mod_list = [(ldap.MOD_REPLACE, name, values)
+                    for name, values in change.changes.items()]
+        return ('modify_ext', (change.dn, mod_list))
+
+    def __applied(self, change, kind):
+        if kind == 'delete':
+            change.delete = False
+        elif kind == 'add':
+            change.attributes = None
+        else:
+            change.changes = {}
+        if change.is_empty():
+            del self._pending[normalize_dn(change.dn)]
+        self.expire(change.dn)
+
+    def __flush(self, wave, kind):
+        requests = [self.__request(change, kind) for change in wave]
+        outcomes = pipeline(self.engine, requests, self.window)
+
+        error = None
+        for change, outcome in zip(wave, outcomes):
+            if outcome is None:
+                self.__applied(change, kind)
+                self.engine._entry_changed(change.dn)
+            elif error is None:
+                error = outcome
+        if error is not None:
+            raise error
@@ -0,0 +1,514 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## This file is part of LDAPAlchemy
+## Copyright (C) 2007 Cleber Rodrigues <cleber.gnu@gmail.com>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rodrigues <cleber.gnu@gmail.com>
+##
+'''
+syncrepl.py
+
+   Provides a Content Synchronization (RFC 4533) consumer, which keeps a
+   copy of part of the directory in memory
+'''
+
+__all__ = ['SyncReplConsumer']
+
+import time
+import logging
+import calendar
+import threading
+
+import ldap
+
+from ldapalchemy.controls import SyncRequestControl, decode_sync_info
+from ldapalchemy.controls import CONTROL_SYNC_STATE, CONTROL_SYNC_DONE
+from ldapalchemy.controls import SYNC_INFO_OID
+from ldapalchemy.controls import SYNC_MODE_REFRESH_ONLY
+from ldapalchemy.controls import SYNC_MODE_REFRESH_AND_PERSIST
+from ldapalchemy.controls import SYNC_STATE_PRESENT, SYNC_STATE_ADD
+from ldapalchemy.controls import SYNC_STATE_DELETE
+from ldapalchemy.expression import NO_ATTRIBUTES, DEFAULT_ATTRIBUTES
+from ldapalchemy.util import normalize_dn, dn_ancestors
+
+#
+# Not defined by older versions of the python ldap module
+#
+RES_INTERMEDIATE = getattr(ldap, 'RES_INTERMEDIATE', 0x79)
+
+log = logging.getLogger('ldapalchemy.syncrepl')
+
+#
+# Seconds to wait before reconnecting after an error
+#
+RETRY_INTERVAL = 5
+
+#
+# Operational attributes requested along with the entries
+#
+SYNC_ATTRIBUTES = ['entryUUID', 'modifyTimestamp']
+
+def parse_generalized_time(value):
+    '''
+    Returns the seconds since the epoch for a GeneralizedTime value such
+    as 20070325174512Z, or None if it can not be parsed
+    '''
+    try:
+        return calendar.timegm(time.strptime(value[:14], '%Y%m%d%H%M%S'))
+    except ValueError:
+        return None
+
+class SyncReplConsumer(object):
+    '''
+    Keeps an in memory copy of the entries found by a search
+
+    The copy is loaded with a refreshOnly synchronization (refresh()),
+    and then kept up to date by a refreshAndPersist one (persist() and
+    process(), or start() to do that in a background thread). Entries
+    held here can be searched without contacting the server, see
+    Search.execute_local().
+
+    Content Synchronization needs the python ldap module to return the
+    controls sent with each entry and the intermediate messages, which
+    is done by result4() in python ldap 2.4 and later. Version 2.3 drops
+    them, so there the copy is instead reloaded every poll_interval
+    seconds, and a warning is logged. stats() tells which mode is used.
+
+    stats() reports, among other things, the replication lag: the time
+    between a entry being modified on the server (its modifyTimestamp)
+    and the change being applied here.
+    '''
+    def __init__(self, search, basedn, scope=ldap.SCOPE_SUBTREE,
+                 attrs=DEFAULT_ATTRIBUTES, poll_interval=60, **params):
+        self.source = search
+        self.basedn = basedn
+        self.scope = scope
+        self.poll_interval = poll_interval
+        self.cookie = None
+
+        self.__filter_string = search._build_filter(**params).compile()
+        attrlist = search._get_attrlist(attrs)
+        if attrlist is None:
+            attrlist = ['*']
+        elif attrlist == NO_ATTRIBUTES:
+            attrlist = []
+        self.__attrlist = list(attrlist) + SYNC_ATTRIBUTES
+
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._uuids = {}
+        self._present = None
+        self._synchronized = False
+        self._sync_supported = None
+
+        self._connection = None
+        self._msgid = None
+        self._thread = None
+        self._stop = threading.Event()
+
+        self.adds = 0
+        self.modifies = 0
+        self.deletes = 0
+        self.refreshes = 0
+        self.errors = 0
+        self.last_error = None
+        self.last_change = None
+        self.last_message = None
+        self.lag = None
+        self.max_lag = None
+
+    #
+    # Synchronization
+    #
+    def refresh(self):
+        '''
+        Brings the local copy up to date, waiting for it
+        '''
+        engine = self.source.bind
+        connection = engine._checkout(True)
+        try:
+            try:
+                self.__check_sync_supported(connection)
+                if self._sync_supported:
+                    msgid = self.__sync_search(connection,
+                                               SYNC_MODE_REFRESH_ONLY)
+                    while not self.__read(connection, msgid, -1):
+                        pass
+                else:
+                    self.__reload(connection)
+            except ldap.SERVER_DOWN:
+                engine._invalidate(connection)
+                raise
+        finally:
+            engine._checkin(connection)
+
+        self.refreshes += 1
+        self._synchronized = True
+
+    def persist(self):
+        '''
+        Starts listening for changes. They are applied by process()
+
+        A connection is held until stop() is called
+        '''
+        if self._connection is not None:
+            return
+
+        engine = self.source.bind
+        connection = engine._checkout(True)
+        try:
+            self._msgid = self.__sync_search(connection,
+                                             SYNC_MODE_REFRESH_AND_PERSIST)
+        except ldap.SERVER_DOWN:
+            engine._invalidate(connection)
+            engine._checkin(connection)
+            raise
+        except:
+            engine._checkin(connection)
+            raise
+        self._connection = connection
+
+    def process(self, timeout=0):
+        '''
+        Applies the changes notified by the server, waiting up to timeout
+        seconds for them. Returns False if the server ended the
+        synchronization, in which case persist() should be called again
+        '''
+        if self._connection is None:
+            return False
+
+        try:
+            while True:
+                if self.__read(self._connection, self._msgid, timeout):
+                    self.__release()
+                    return False
+                timeout = 0
+        except ldap.TIMEOUT:
+            return True
+        except _NothingToRead:
+            return True
+        except ldap.SERVER_DOWN:
+            self.source.bind._invalidate(self._connection)
+            self.__release()
+            raise
+        except ldap.LDAPError:
+            self.__release()
+            raise
+
+    def start(self):
+        '''
+        Keeps the local copy up to date from a background thread
+        '''
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.__run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stops listening for changes, and the background thread if any
+        '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._connection is not None:
+            try:
+                self._connection.abandon(self._msgid)
+            except ldap.LDAPError:
+                pass
+            self.__release()
+
+    #
+    # Access to the local copy
+    #
+    def find(self, basedn, scope, element, attrlist=None):
+        '''
+        Returns the entries held here that are within basedn and scope and
+        match the given filter element, as (dn, attributes) tuples
+        '''
+        base = normalize_dn(basedn)
+        self._lock.acquire()
+        try:
+            entries = self._entries.values()
+        finally:
+            self._lock.release()
+
+        result = []
+        for dn, attrs, ancestors in entries:
+            if base not in ancestors:
+                continue
+            depth = ancestors.index(base)
+            if (scope == ldap.SCOPE_BASE and depth != 0) or \
+                    (scope == ldap.SCOPE_ONELEVEL and depth != 1):
+                continue
+            if element.match(attrs):
+                result.append((dn, self.__project(attrs, attrlist)))
+        return result
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        '''
+        Returns a dict with the synchronization counters and lag
+        '''
+        now = time.time()
+        since_change = since_message = None
+        if self.last_change is not None:
+            since_change = now - self.last_change
+        if self.last_message is not None:
+            since_message = now - self.last_message
+
+        mode = None
+        if self._sync_supported is not None:
+            mode = self._sync_supported and 'sync' or 'reload'
+
+        return {'entries' : len(self._entries),
+                'mode' : mode,
+                'cookie' : self.cookie,
+                'adds' : self.adds,
+                'modifies' : self.modifies,
+                'deletes' : self.deletes,
+                'refreshes' : self.refreshes,
+                'errors' : self.errors,
+                'persisting' : self._connection is not None,
+                'lag' : self.lag,
+                'max_lag' : self.max_lag,
+                'since_change' : since_change,
+                'since_message' : since_message}
+
+    #
+    # Internal Methods
+    #
+    def __run(self):
+        while not self._stop.isSet():
+            try:
+                if not self._synchronized:
+                    self.refresh()
+                if not self._sync_supported:
+                    self._stop.wait(self.poll_interval)
+                    self._synchronized = False
+                    continue
+                self.persist()
+                while not self._stop.isSet() and self.process(1):
+                    pass
+            except ldap.LDAPError, error:
+                self.errors += 1
+                self.last_error = error
+                self._stop.wait(RETRY_INTERVAL)
+
+    def __check_sync_supported(self, connection):
+        supported = hasattr(connection, 'result4')
+        if not supported and self._sync_supported is None:
+            log.warning('python ldap %s does not return the controls sent '
+                        'with entries, so Content Synchronization can not '
+                        'be used: reloading %s every %s seconds instead',
+                        ldap.__version__, self.basedn, self.poll_interval)
+        self._sync_supported = supported
+
+    def __release(self):
+        if self._connection is not None:
+            self.source.bind._checkin(self._connection)
+        self._connection = None
+        self._msgid = None
+
+    def __sync_search(self, connection, mode):
+        '''
+        Issues the synchronization search and returns its message id
+        '''
+        self._lock.acquire()
+        try:
+            self._present = {}
+        finally:
+            self._lock.release()
+
+        control = SyncRequestControl(True, (mode, self.cookie, False))
+        return connection.search_ext(self.basedn, self.scope,
+                                     self.__filter_string, self.__attrlist,
+                                     serverctrls=[control])
+
+    def __read(self, connection, msgid, timeout):
+        '''
+        Reads and applies one message. Returns True when the search is done
+        '''
+        rtype, rdata, rmsgid, rctrls = connection.result4(
+            msgid, 0, timeout, add_ctrls=1, add_intermediates=1)[:4]
+        if rtype is None:
+            raise _NothingToRead
+        self.last_message = time.time()
+
+        if rtype == ldap.RES_SEARCH_ENTRY:
+            for dn, attrs, ctrls in rdata:
+                self.__apply_entry(dn, attrs, ctrls)
+        elif rtype == RES_INTERMEDIATE:
+            for name, value, ctrls in rdata:
+                if name == SYNC_INFO_OID:
+                    self.__apply_info(decode_sync_info(value))
+        elif rtype == ldap.RES_SEARCH_RESULT:
+            for rctrl in rctrls:
+                if rctrl.controlType == CONTROL_SYNC_DONE:
+                    cookie, refresh_deletes = rctrl.controlValue
+                    if cookie:
+                        self.cookie = cookie
+                    self.__end_refresh(not refresh_deletes)
+            return True
+        return False
+
+    def __reload(self, connection):
+        '''
+        Reloads all entries, for when Content Synchronization can not be
+        used
+        '''
+        result = connection.search_s(self.basedn, self.scope,
+                                     self.__filter_string, self.__attrlist)
+        self._lock.acquire()
+        try:
+            self._present = {}
+            for dn, attrs in result:
+                self.__apply_entry(dn, attrs, [])
+            self.__end_refresh(True)
+        finally:
+            self._lock.release()
+
+    def __apply_entry(self, dn, attrs, ctrls):
+        state, uuid, cookie = SYNC_STATE_ADD, None, None
+        for ctrl in ctrls:
+            if ctrl.controlType == CONTROL_SYNC_STATE:
+                state, uuid, cookie = ctrl.controlValue
+        if uuid is None:
+            uuid = self.__get_value(attrs, 'entryUUID') or normalize_dn(dn)
+
+        self._lock.acquire()
+        try:
+            if self._present is not None:
+                self._present[uuid] = True
+
+            if state == SYNC_STATE_DELETE:
+                self.__remove(uuid)
+            elif state != SYNC_STATE_PRESENT:
+                self.__store(uuid, dn, attrs)
+        finally:
+            self._lock.release()
+
+        if cookie:
+            self.cookie = cookie
+
+    def __apply_info(self, info):
+        kind, cookie, flag, uuids = info
+        if cookie:
+            self.cookie = cookie
+
+        if kind == 'syncIdSet':
+            self._lock.acquire()
+            try:
+                for uuid in uuids:
+                    if flag:
+                        self.__remove(uuid)
+                    elif self._present is not None:
+                        self._present[uuid] = True
+            finally:
+                self._lock.release()
+        elif kind in ('refreshPresent', 'refreshDelete') and flag:
+            self.__end_refresh(kind == 'refreshPresent')
+
+    def __end_refresh(self, purge):
+        '''
+        Ends the refresh phase. After a present phase, entries the server
+        did not mention are gone
+        '''
+        self._lock.acquire()
+        try:
+            if purge and self._present is not None:
+                for uuid in self._uuids.keys():
+                    if not self._present.has_key(uuid):
+                        self.__remove(uuid)
+            self._present = None
+        finally:
+            self._lock.release()
+
+    def __store(self, uuid, dn, attrs):
+        key = normalize_dn(dn)
+        old_key = self._uuids.get(uuid)
+        if old_key is not None:
+            if old_key == key and self._entries[key][1] == attrs:
+                return
+            del self._entries[old_key]
+            self.modifies += 1
+        else:
+            self.adds += 1
+
+        self._entries[key] = (dn, attrs, dn_ancestors(dn))
+        self._uuids[uuid] = key
+        self.__changed(attrs)
+
+    def __remove(self, uuid):
+        key = self._uuids.pop(uuid, None)
+        if key is not None:
+            del self._entries[key]
+            self.deletes += 1
+            self.__changed(None)
+
+    def __changed(self, attrs):
+        '''
+        Updates the change time and lag metrics
+        '''
+        now = time.time()
+        self.last_change = now
+
+        #
+        # Lag is only meaningful for changes made after the first refresh,
+        # the initial load brings entries modified long ago
+        #
+        if attrs is None or not self._synchronized:
+            return
+        modified = self.__get_value(attrs, 'modifyTimestamp')
+        if modified is None:
+            return
+        modified = parse_generalized_time(modified)
+        if modified is None:
+            return
+        self.lag = max(now - modified, 0)
+        self.max_lag = max(self.max_lag, self.lag)
+
+    def __get_value(self, attrs, name):
+        name = name.lower()
+        for key, values in attrs.items():
+            if key.lower() == name and values:
+                return values[0]
+        return None
+
+    def __project(self, attrs, attrlist):
+        if attrlist is None:
+            return dict(attrs)
+        if attrlist == NO_ATTRIBUTES:
+            return {}
+        wanted = [a.lower() for a in attrlist]
+        return dict([(k, v) for k, v in attrs.items() \
+                         if k.lower() in wanted])
+
+class _NothingToRead(Exception):
+    '''
+    Raised internally when a non blocking read finds no message
+    '''
+    pass
@@ -0,0 +1,337 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## This file is part of LDAPAlchemy
+## Copyright (C) 2007 Cleber Rodrigues <cleber.gnu@gmail.com>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rodrigues <cleber.gnu@gmail.com>
+##
+'''
+syntaxes.py
+
+   Provides value checks and conversions for attribute syntaxes
+
+   Values are always sent to and received from the server as strings. The
+   codecs here convert them from and to Python types, according to the
+   syntax of each attribute in the schema:
+
+      Boolean             bool
+      Distinguished Name  DN
+      Generalized Time    datetime.datetime (naive, in UTC)
+      Integer             int (or long)
+'''
+
+__all__ = ['DN', 'Codec', 'CodecTable', 'attribute_syntax',
+           'SYNTAX_CHECKS', 'SYNTAX_CODECS',
+           'SYNTAX_BOOLEAN', 'SYNTAX_DN', 'SYNTAX_GENERALIZED_TIME',
+           'SYNTAX_IA5_STRING', 'SYNTAX_INTEGER', 'SYNTAX_NUMERIC_STRING',
+           'SYNTAX_OID', 'SYNTAX_PRINTABLE_STRING']
+
+import re
+import datetime
+
+import ldap
+import ldap.dn
+
+from ldapalchemy.schema import ElementNotFoundError
+from ldapalchemy.util import normalize_dn
+
+#
+# Syntax OIDs (RFC 4517)
+#
+SYNTAX_BOOLEAN = '1.3.6.1.4.1.1466.115.121.1.7'
+SYNTAX_DN = '1.3.6.1.4.1.1466.115.121.1.12'
+SYNTAX_GENERALIZED_TIME = '1.3.6.1.4.1.1466.115.121.1.24'
+SYNTAX_IA5_STRING = '1.3.6.1.4.1.1466.115.121.1.26'
+SYNTAX_INTEGER = '1.3.6.1.4.1.1466.115.121.1.27'
+SYNTAX_NUMERIC_STRING = '1.3.6.1.4.1.1466.115.121.1.36'
+SYNTAX_OID = '1.3.6.1.4.1.1466.115.121.1.38'
+SYNTAX_PRINTABLE_STRING = '1.3.6.1.4.1.1466.115.121.1.44'
+
+GENERALIZED_TIME_RE = re.compile(r'(\d{4})(\d{2})(\d{2})(\d{2})'
+                                 r'(\d{2})?(\d{2})?([.,]\d+)?'
+                                 r'(Z|[+-]\d{2}(\d{2})?)\Z')
+
+def attribute_syntax(schema, at):
+    '''
+    Returns the syntax OID of the attribute type object at, which may be
+    inherited from its superior attribute types, or None
+    '''
+    seen = {}
+    while at.syntax is None and at.sup and not seen.has_key(at.oid):
+        seen[at.oid] = True
+        try:
+            at = schema.get_at_obj_by_name(at.sup[0])
+        except ElementNotFoundError:
+            return None
+    return at.syntax
+
+#
+# Value checks for the most common syntaxes
+#
+def _regex_check(pattern):
+    match = re.compile(pattern).match
+    return lambda value: match(value) is not None
+
+def _dn_check(value):
+    try:
+        ldap.dn.str2dn(value)
+    except (ldap.DECODING_ERROR, ValueError):
+        return False
+    return True
+
+SYNTAX_CHECKS = {
+    SYNTAX_BOOLEAN : _regex_check(r'(TRUE|FALSE)\Z'),
+    SYNTAX_DN : _dn_check,
+    SYNTAX_GENERALIZED_TIME : GENERALIZED_TIME_RE.match,
+    SYNTAX_IA5_STRING : _regex_check(r'[\x00-\x7f]*\Z'),
+    SYNTAX_INTEGER : _regex_check(r'-?\d+\Z'),
+    SYNTAX_NUMERIC_STRING : _regex_check(r'[\d ]+\Z'),
+    SYNTAX_OID : _regex_check(r'([A-Za-z][A-Za-z0-9-]*|\d+(\.\d+)*)\Z'),
+    SYNTAX_PRINTABLE_STRING : _regex_check(r"[A-Za-z0-9'()+,.=/:? -]+\Z"),
+    }
+
+class DN(str):
+    '''
+    A distinguished name
+
+    It is still a string, as sent by the server, but compares (and
+    hashes) by its normalized form, so 'CN=Foo, dc=x' == 'cn=foo,dc=x'
+    '''
+    def __get_normalized(self):
+        return normalize_dn(self)
+    normalized = property(__get_normalized)
+
+    def __eq__(self, other):
+        if not isinstance(other, basestring):
+            return False
+        return self.normalized == normalize_dn(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.normalized)
+
+    def rdns(self):
+        '''
+        Returns the RDNs of this DN, as parsed by ldap.dn.str2dn
+        '''
+        return ldap.dn.str2dn(self)
+
+    def parent(self):
+        '''
+        Returns the DN of the parent entry, or None for the root DN
+        '''
+        rdns = ldap.dn.str2dn(self)
+        if not rdns:
+            return None
+        return DN(ldap.dn.dn2str(rdns[1:]))
+
+class Codec:
+    '''
+    Converts the values of a syntax from and to Python types
+
+    decode() gets the string sent by the server and returns the Python
+    value. encode() gets a Python value and returns the string to send.
+    Strings given to encode() are sent as they are.
+    '''
+    def decode(self, value):
+        return value
+
+    def encode(self, value):
+        return str(value)
+
+class IntegerCodec(Codec):
+    def decode(self, value):
+        return int(value)
+
+class BooleanCodec(Codec):
+    def decode(self, value):
+        return value == 'TRUE'
+
+    def encode(self, value):
+        if value:
+            return 'TRUE'
+        return 'FALSE'
+
+class GeneralizedTimeCodec(Codec):
+    def decode(self, value):
+        match = GENERALIZED_TIME_RE.match(value)
+        if match is None:
+            raise ValueError, value
+        (year, month, day, hour, minute, second,
+         fraction, zone, zone_minutes) = match.groups()
+
+        result = datetime.datetime(int(year), int(month), int(day),
+                                   int(hour), int(minute or 0),
+                                   int(second or 0))
+
+        #
+        # The fraction is of the last field given
+        #
+        if fraction:
+            fraction = float('0.' + fraction[1:])
+            if minute is None:
+                result += datetime.timedelta(hours=fraction)
+            elif second is None:
+                result += datetime.timedelta(minutes=fraction)
+            else:
+                result += datetime.timedelta(seconds=fraction)
+
+        if zone != 'Z':
+            offset = datetime.timedelta(hours=int(zone[1:3]),
+                                        minutes=int(zone[3:5] or 0))
+            if zone[0] == '+':
+                result -= offset
+            else:
+                result += offset
+        return result
+
+    def encode(self, value):
+        if not isinstance(value, datetime.datetime):
+            return str(value)
+        offset = value.utcoffset()
+        if offset is not None:
+            value = value.replace(tzinfo=None) - offset
+
+        #
+        # Not strftime(), which refuses years before 1900 that decode()
+        # accepts
+        #
+        result = '%04d%02d%02d%02d%02d%02d' % (value.year, value.month,
+                                               value.day, value.hour,
+                                               value.minute, value.second)
+        if value.microsecond:
+            result += ('.%06d' % value.microsecond).rstrip('0')
+        return result + 'Z'
+
+class DNCodec(Codec):
+    def decode(self, value):
+        return DN(value)
+
+SYNTAX_CODECS = {
+    SYNTAX_BOOLEAN : BooleanCodec(),
+    SYNTAX_DN : DNCodec(),
+    SYNTAX_GENERALIZED_TIME : GeneralizedTimeCodec(),
+    SYNTAX_INTEGER : IntegerCodec(),
+    }
+
+class CodecTable(object):
+    '''
+    The codecs for the attributes of entries, worked out from a schema
+
+    The codec of each attribute is looked up only once: the attributes
+    of a template (and their alternative names) when the table is built,
+    any other attribute, such as operational ones, the first time it is
+    seen. Attributes with no codec have their values left as strings.
+    '''
+    def __init__(self, schema, names=()):
+        self.schema = schema
+        self._codecs = {}
+        for name in names:
+            self.__resolve(name)
+
+    def __resolve(self, name):
+        '''
+        Returns the codec for the named attribute, or None, remembering it
+        under the exact name given, the lower case one and its aliases
+        '''
+        key = name.lower()
+        if self._codecs.has_key(key):
+            codec = self._codecs[key]
+            self._codecs[name] = codec
+            return codec
+
+        codec = None
+        names = [name]
+        if self.schema is not None:
+            try:
+                at = self.schema.get_at_obj_by_name(name)
+            except ElementNotFoundError:
+                pass
+            else:
+                codec = SYNTAX_CODECS.get(attribute_syntax(self.schema, at))
+                names += at.names
+
+        for alias in names:
+            self._codecs[alias] = codec
+            self._codecs[alias.lower()] = codec
+        return codec
+
+    def get(self, name):
+        '''
+        Returns the codec for the named attribute, or None
+        '''
+        try:
+            return self._codecs[name]
+        except KeyError:
+            return self.__resolve(name)
+
+    def decode(self, attributes):
+        '''
+        Returns a copy of the attributes dict of a entry, with its values
+        converted to Python types. Values the codec can not convert are
+        kept as they are
+        '''
+        codecs = self._codecs
+        result = {}
+        for name, values in attributes.iteritems():
+            try:
+                codec = codecs[name]
+            except KeyError:
+                codec = self.__resolve(name)
+            if codec is not None:
+                try:
+                    values = [codec.decode(v) for v in values]
+                except ValueError:
+                    pass
+            result[name] = values
+        return result
+
+    def decode_result(self, result):
+        '''
+        Returns the (dn, attributes) tuples of a whole search result with
+        their values converted to Python types
+        '''
+        decode = self.decode
+        return [(dn, decode(attributes)) for dn, attributes in result]
+
+    def encode(self, params):
+        '''
+        Returns a copy of a dict of attribute names to values (single
+        values or lists) with Python values converted to strings. None
+        values are kept
+        '''
+        result = {}
+        for name, values in params.iteritems():
+            codec = self.get(name)
+            if codec is not None and values is not None:
+                if type(values) in (list, tuple):
+                    values = [self.__encode(codec, v) for v in values]
+                else:
+                    values = self.__encode(codec, values)
+            result[name] = values
+        return result
+
+    def __encode(self, codec, value):
+        if isinstance(value, basestring):
+            return value
+        return codec.encode(value)
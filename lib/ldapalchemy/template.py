@@ -29,13 +29,17 @@ template.py
    Provides Template For Entering Directory Entries
 '''
 
-__all__ = ['Template', 'Table']
+__all__ = ['Template', 'Table', 'ValidationPlan']
 
 from ldapalchemy.config import DefaultConfig
 from ldapalchemy.elements import ObjectClassElement, AttributeTypeElement
+from ldapalchemy.entry import AttributeAliases
 from ldapalchemy.expression import Add, Modify, Delete, Search
+from ldapalchemy.filters import AttributeCollection
+from ldapalchemy.optimizer import FilterOptimizer
 from ldapalchemy.schema import OC_KIND_ABSTRACT, OC_KIND_STRUCTURAL, \
-    OC_KIND_AUXILIARY
+    OC_KIND_AUXILIARY, ElementNotFoundError
+from ldapalchemy.syntaxes import CodecTable, SYNTAX_CHECKS, attribute_syntax
 
 #
 # Exceptions
@@ -52,6 +56,116 @@ class RdnAttributeNotSetError(Exception):
     '''
     pass
 
+class ValidationPlan(object):
+    '''
+    Everything needed to validate the attributes of entries built with a
+    template, worked out once from the schema
+
+    Attribute names are matched case insensitively and by any of their
+    names in the schema. The plan has:
+
+       * allowed: the (lower case) names of all allowed attributes
+       * required: the (lower case) mandatory attributes, but objectClass,
+         which is always set by the template
+       * single_value: the (lower case) SINGLE-VALUE attributes
+       * checks: a function checking a value, for attributes with a syntax
+         found in SYNTAX_CHECKS
+
+    Required, single valued and checked attributes are named as in the
+    template's objectClasses, and canonical() maps any allowed name to
+    that name.
+    '''
+    def __init__(self, template):
+        self._canonical = {}
+        self._names = {}
+        single_value = []
+        checks = {}
+
+        schema = template.schema
+        for name in template.attribute_names:
+            key = name.lower()
+            if self._names.has_key(key):
+                continue
+            self._names[key] = name
+            self._canonical[key] = key
+
+            try:
+                at = schema.get_at_obj_by_name(name)
+            except ElementNotFoundError:
+                continue
+            for alias in at.names:
+                self._canonical.setdefault(alias.lower(), key)
+            if at.single_value:
+                single_value.append(key)
+            check = SYNTAX_CHECKS.get(attribute_syntax(schema, at))
+            if check is not None:
+                checks[key] = check
+
+        self.allowed = frozenset(self._canonical.keys())
+        self.required = frozenset([n.lower() for n in \
+                                       template.attribute_must_names \
+                                       if n.lower() != 'objectclass'])
+        self.single_value = frozenset(single_value)
+        self.checks = checks
+
+    def canonical(self, name):
+        '''
+        Returns the (lower case) template name of the attribute called
+        name, or None if it is not allowed
+        '''
+        return self._canonical.get(name.lower())
+
+    def name(self, key):
+        '''
+        Returns the attribute name, as in the template, for a canonical
+        (lower case) name
+        '''
+        return self._names[key]
+
+    def validate(self, params, errors, require=True):
+        '''
+        Checks a dict of attribute names to values (single values, lists,
+        or None) in a single pass
+
+        errors is the tuple of exceptions to raise for a attribute that is
+        not allowed, a missing mandatory attribute, many values for a
+        SINGLE-VALUE attribute and a value with invalid syntax. Mandatory
+        attributes are only looked for if require is True.
+        '''
+        not_may, not_must, not_single_value, invalid_syntax = errors
+        canonical = self._canonical
+        single_value = self.single_value
+        checks = self.checks
+
+        present = []
+        for name, value in params.iteritems():
+            key = canonical.get(name.lower())
+            if key is None:
+                raise not_may, name
+            present.append(key)
+            if value is None:
+                continue
+
+            if type(value) in (list, tuple):
+                if len(value) > 1 and key in single_value:
+                    raise not_single_value, name
+                values = value
+            else:
+                values = (value,)
+
+            check = checks.get(key)
+            if check is not None:
+                for v in values:
+                    if not isinstance(v, basestring):
+                        v = str(v)
+                    if not check(v):
+                        raise invalid_syntax, (name, v)
+
+        if require:
+            missing = self.required.difference(present)
+            if missing:
+                raise not_must, self._names[min(missing)]
+
 #
 # Classes used for building templates
 #
@@ -77,12 +191,17 @@ class Template(object):
 
     Limitations: No multi-value attribute RDN is allowed so far
     '''
-    def __init__(self, name, schema, *args):
+    def __init__(self, name, schema, *args, **kwargs):
         '''
         Initializes a new template
+
+        The cache_ttl keyword argument sets for how long results of
+        searches made with this template can be cached by the engine. By
+        default, the engine's cache TTL is used.
         '''
         self.name = name
         self.schema = schema
+        self.cache_ttl = kwargs.get('cache_ttl')
         self.object_classes = []
         self.attribute_types = []
         self.rdn_attribute_name = None
@@ -98,6 +217,33 @@ class Template(object):
         self.__add_sup_ocs()
         self.__reorder_ocs()
 
+        #
+        # The object classes do not change from now on, so the attribute
+        # names and the way to validate them are only worked out once
+        #
+        self.__compile_attribute_names()
+        self.validation_plan = ValidationPlan(self)
+
+        #
+        # Attributes for use in filter expressions, as in "template.c.uid"
+        #
+        self.c = AttributeCollection(self)
+
+        #
+        # Rewrites search filters based on the schema
+        #
+        self.optimizer = FilterOptimizer(self.schema)
+
+        #
+        # Alternative attribute names, for lookups on search results
+        #
+        self.aliases = AttributeAliases(self.schema)
+
+        #
+        # Conversion of values from and to Python types
+        #
+        self.codecs = CodecTable(self.schema, self.attribute_names)
+
     def __process_args(self, args):
         for arg in args:
             if isinstance(arg, ObjectClass):
@@ -140,32 +286,49 @@ class Template(object):
                 return True
         return False
 
+    def __compile_attribute_names(self):
+        '''
+        Collects the names of the 'may' and 'must' attributes of this
+        template's ocs, in order and without duplicates
+        '''
+        def unique(names):
+            seen = {}
+            result = []
+            for name in names:
+                if not seen.has_key(name.lower()):
+                    seen[name.lower()] = True
+                    result.append(name)
+            return tuple(result)
+
+        may = []
+        must = []
+        for oc in self.object_classes:
+            may += oc.may
+            must += oc.must
+        may += self.at_extra_may
+        must += self.at_extra_must
+
+        self.__may_names = unique(may)
+        self.__must_names = unique(must)
+        self.__attribute_names = unique(may + must)
+
     def __get_all_may_attribute_names(self):
         '''
         Returns the name of all 'may' attributes in this template's ocs
         '''
-        all_may = []
-        for oc in self.object_classes:
-            all_may += oc.may
-        return all_may
+        return self.__may_names
 
     def __get_all_must_attribute_names(self):
         '''
         Returns the name of all 'must' attributes in this template's ocs
         '''
-        all_must = []
-        for oc in self.object_classes:
-            all_must += oc.must
-        return all_must
+        return self.__must_names
 
     def __get_all_attribute_names(self):
         '''
         Returns all attribute names mentioned in given object_classes
         '''
-        may_attr = self.__get_all_may_attribute_names()
-        must_attr = self.__get_all_must_attribute_names()
-
-        return may_attr + must_attr
+        return self.__attribute_names
 
     def __get_all_object_class_names(self):
         '''
@@ -231,11 +394,13 @@ class Template(object):
         '''
         return Delete(self)
     
-    def search(self):
+    def search(self, attrs=None):
         '''
         Returns a "Search" expression
+
+        attrs is the list of attributes to be returned, see Search
         '''
-        return Search(self)
+        return Search(self, attrs)
 
     #
     # Properties
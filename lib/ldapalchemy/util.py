@@ -32,7 +32,9 @@ util.py
    Provides miscelanious utilities classes and functions
 '''
 
-__all__ = [ 'OrderedDict', ]
+__all__ = [ 'OrderedDict', 'normalize_dn', 'dn_ancestors', ]
+
+import ldap.dn
 
 
 class OrderedDict(dict):
@@ -114,3 +116,33 @@ class OrderedDict(dict):
         item = dict.popitem(self)
         self._list.remove(item[0])
         return item
+
+
+def _normalized_rdns(dn):
+    '''
+    Returns the list of normalized RDNs of dn, leaf first
+    '''
+    rdns = []
+    for rdn in ldap.dn.str2dn(dn):
+        avas = ['%s=%s' % (attr.lower(), ldap.dn.escape_dn_chars(val.lower())) \
+                    for attr, val, flags in rdn]
+        avas.sort()
+        rdns.append('+'.join(avas))
+    return rdns
+
+def normalize_dn(dn):
+    '''
+    Returns a normalized form of dn, suitable for comparing DNs
+
+    Attribute types and values are lower cased, extra spaces are removed
+    and multi-valued RDNs are sorted.
+    '''
+    return ','.join(_normalized_rdns(dn))
+
+def dn_ancestors(dn):
+    '''
+    Returns the normalized DNs of dn itself and all its ancestors, up to
+    (and including) the root DN, which is the empty string
+    '''
+    rdns = _normalized_rdns(dn)
+    return [','.join(rdns[i:]) for i in range(len(rdns) + 1)]
@@ -0,0 +1,350 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## This file is part of LDAPAlchemy
+## Copyright (C) 2007 Cleber Rodrigues <cleber.gnu@gmail.com>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rodrigues <cleber.gnu@gmail.com>
+##
+'''
+test_syncrepl.py
+
+   Tests SyncReplConsumer against a stand-in Content Synchronization
+   (RFC 4533) server, so no LDAP server is needed
+'''
+
+import logging
+import unittest
+
+import ldap
+import ldap.controls
+
+from ldapalchemy.controls import ber_decode, ber_decode_sequence, \
+    ber_decode_integer, ber_encode, ber_integer, ber_boolean, ber_sequence, \
+    TAG_ENUMERATED, TAG_OCTET_STRING, CONTROL_SYNC_REQUEST, \
+    CONTROL_SYNC_STATE, CONTROL_SYNC_DONE, SYNC_INFO_OID, \
+    SYNC_MODE_REFRESH_AND_PERSIST, SYNC_STATE_PRESENT, SYNC_STATE_ADD, \
+    SYNC_STATE_MODIFY, SYNC_STATE_DELETE
+from ldapalchemy.expression import DEFAULT_ATTRIBUTES
+from ldapalchemy.filters import Present
+from ldapalchemy.syncrepl import SyncReplConsumer, RES_INTERMEDIATE
+
+BASE = 'dc=example,dc=com'
+
+#
+# Encoding of the messages sent by the server
+#
+def state_control(state, uuid, cookie=None):
+    items = [ber_integer(state, TAG_ENUMERATED),
+             ber_encode(TAG_OCTET_STRING, uuid)]
+    if cookie:
+        items.append(ber_encode(TAG_OCTET_STRING, cookie))
+    return decode_control(CONTROL_SYNC_STATE, ber_sequence(*items))
+
+def done_control(cookie, refresh_deletes):
+    items = [ber_encode(TAG_OCTET_STRING, cookie)]
+    if refresh_deletes:
+        items.append(ber_boolean(True))
+    return decode_control(CONTROL_SYNC_DONE, ber_sequence(*items))
+
+def refresh_info(cookie, refresh_deletes):
+    tag = refresh_deletes and 0xa1 or 0xa2
+    return ber_sequence(ber_encode(TAG_OCTET_STRING, cookie),
+                        ber_boolean(True), tag=tag)
+
+def decode_control(oid, value):
+    '''
+    Decodes a response control the way the python ldap module does
+    '''
+    return ldap.controls.DecodeControlTuples([(oid, False, value)])[0]
+
+class StandInServer:
+    '''
+    Keeps entries along with the change sequence number (CSN) of their
+    last change, and answers Content Synchronization searches. The cookie
+    is the last CSN
+
+    Refreshes started with a cookie use the present phase, or the delete
+    phase if refresh_deletes is set.
+    '''
+    def __init__(self):
+        self.csn = 0
+        self.entries = {}
+        self.deleted = {}
+        self.refresh_deletes = False
+        self.cookies_received = []
+        self.listeners = []
+        self.next_uuid = 0
+
+    def cookie(self):
+        return str(self.csn)
+
+    def add(self, dn, **attrs):
+        self.next_uuid += 1
+        uuid = 'uuid-%d' % self.next_uuid
+        self.__change(uuid, dn, attrs, SYNC_STATE_ADD)
+        return uuid
+
+    def modify(self, uuid, **attrs):
+        dn = self.entries[uuid][0]
+        self.__change(uuid, dn, attrs, SYNC_STATE_MODIFY)
+
+    def delete(self, uuid):
+        self.csn += 1
+        dn = self.entries.pop(uuid)[0]
+        self.deleted[uuid] = (dn, self.csn)
+        for listener in self.listeners:
+            listener(dn, {}, state_control(SYNC_STATE_DELETE, uuid,
+                                           self.cookie()))
+
+    def __change(self, uuid, dn, attrs, state):
+        self.csn += 1
+        attrs = dict([(k, [v]) for k, v in attrs.items()])
+        attrs['objectClass'] = ['person']
+        attrs['entryUUID'] = [uuid]
+        self.entries[uuid] = (dn, attrs, self.csn)
+        for listener in self.listeners:
+            listener(dn, attrs, state_control(state, uuid, self.cookie()))
+
+    def refresh(self, cookie):
+        '''
+        Returns the (dn, attributes, control) of the entries to send for
+        a refresh from cookie
+        '''
+        self.cookies_received.append(cookie)
+        since = int(cookie or 0)
+
+        result = []
+        for uuid, (dn, attrs, csn) in self.entries.items():
+            if csn > since:
+                result.append((dn, attrs,
+                               state_control(SYNC_STATE_ADD, uuid)))
+            elif not self.refresh_deletes:
+                result.append((dn, {},
+                               state_control(SYNC_STATE_PRESENT, uuid)))
+        if self.refresh_deletes:
+            for uuid, (dn, csn) in self.deleted.items():
+                if csn > since:
+                    result.append((dn, {},
+                                   state_control(SYNC_STATE_DELETE, uuid)))
+        return result
+
+class StandInConnection:
+    '''
+    Answers the calls made by SyncReplConsumer on a python ldap 2.4
+    connection
+    '''
+    def __init__(self, server):
+        self.server = server
+        self.queues = {}
+        self.next_msgid = 0
+
+    def search_ext(self, base, scope, filterstr, attrlist=None, attrsonly=0,
+                   serverctrls=None, clientctrls=None, timeout=-1,
+                   sizelimit=0):
+        control = serverctrls[0]
+        assert control.controlType == CONTROL_SYNC_REQUEST
+        tag, contents, rest = ber_decode(control.encodeControlValue())
+        items = ber_decode_sequence(contents)
+        mode = ber_decode_integer(items[0][1])
+        cookie = None
+        if len(items) > 1 and items[1][0] == TAG_OCTET_STRING:
+            cookie = items[1][1]
+
+        self.next_msgid += 1
+        msgid = self.next_msgid
+        queue = self.queues[msgid] = []
+        for dn, attrs, ctrl in self.server.refresh(cookie):
+            queue.append((ldap.RES_SEARCH_ENTRY, [(dn, attrs, [ctrl])]))
+
+        refresh_deletes = self.server.refresh_deletes and cookie is not None
+        if mode == SYNC_MODE_REFRESH_AND_PERSIST:
+            info = refresh_info(self.server.cookie(), refresh_deletes)
+            queue.append((RES_INTERMEDIATE, [(SYNC_INFO_OID, info, [])]))
+
+            def listener(dn, attrs, ctrl):
+                queue.append((ldap.RES_SEARCH_ENTRY, [(dn, attrs, [ctrl])]))
+            self.server.listeners.append(listener)
+        else:
+            done = done_control(self.server.cookie(), refresh_deletes)
+            queue.append((ldap.RES_SEARCH_RESULT, [], [done]))
+        return msgid
+
+    def result4(self, msgid, all=1, timeout=-1, add_ctrls=0,
+                add_intermediates=0, add_extop=0, resp_ctrl_classes=None):
+        queue = self.queues[msgid]
+        if not queue:
+            if timeout == 0:
+                return (None, None, None, None, None, None)
+            raise ldap.TIMEOUT
+        message = queue.pop(0)
+        rctrls = []
+        if len(message) > 2:
+            rctrls = message[2]
+        return (message[0], message[1], msgid, rctrls, None, None)
+
+    def abandon(self, msgid):
+        self.queues.pop(msgid, None)
+        self.server.listeners = []
+
+class ReloadOnlyConnection:
+    '''
+    A python ldap 2.3 connection, which has no result4()
+    '''
+    def __init__(self, server):
+        self.server = server
+
+    def search_s(self, base, scope, filterstr, attrlist=None):
+        return [(dn, attrs) for dn, attrs, csn in self.server.entries.values()]
+
+class StandInEngine:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def _checkout(self, read):
+        return self.connection
+
+    def _checkin(self, connection):
+        pass
+
+    def _invalidate(self, connection):
+        pass
+
+class StandInSearch:
+    def __init__(self, engine):
+        self.bind = engine
+
+    def _build_filter(self, **params):
+        return Present('objectClass')
+
+    def _get_attrlist(self, attrs):
+        if attrs is DEFAULT_ATTRIBUTES:
+            return None
+        return attrs
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+class SyncReplConsumerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.ann = self.server.add('uid=ann,' + BASE, uid='ann', sn='A')
+        self.bob = self.server.add('uid=bob,' + BASE, uid='bob', sn='B')
+        self.cid = self.server.add('uid=cid,' + BASE, uid='cid', sn='C')
+
+        engine = StandInEngine(StandInConnection(self.server))
+        self.consumer = SyncReplConsumer(StandInSearch(engine), BASE)
+
+    def entries(self):
+        result = self.consumer.find(BASE, ldap.SCOPE_SUBTREE,
+                                    Present('objectClass'))
+        entries = {}
+        for dn, attrs in result:
+            entries[dn] = attrs.get('sn')
+        return entries
+
+    def test_initial_refresh(self):
+        self.consumer.refresh()
+
+        self.assertEqual(self.server.cookies_received, [None])
+        self.assertEqual(self.consumer.cookie, '3')
+        self.assertEqual(self.entries(),
+                         {'uid=ann,' + BASE : ['A'],
+                          'uid=bob,' + BASE : ['B'],
+                          'uid=cid,' + BASE : ['C']})
+        self.assertEqual(self.consumer.stats()['mode'], 'sync')
+
+    def test_present_phase_resumes_from_cookie(self):
+        self.consumer.refresh()
+
+        self.server.modify(self.ann, uid='ann', sn='AA')
+        self.server.delete(self.bob)
+        self.server.add('uid=dan,' + BASE, uid='dan', sn='D')
+        self.consumer.refresh()
+
+        self.assertEqual(self.server.cookies_received, [None, '3'])
+        self.assertEqual(self.consumer.cookie, '6')
+        self.assertEqual(self.entries(),
+                         {'uid=ann,' + BASE : ['AA'],
+                          'uid=cid,' + BASE : ['C'],
+                          'uid=dan,' + BASE : ['D']})
+        self.assertEqual(self.consumer.stats()['deletes'], 1)
+
+    def test_delete_phase_resumes_from_cookie(self):
+        self.consumer.refresh()
+
+        self.server.refresh_deletes = True
+        self.server.delete(self.cid)
+        self.consumer.refresh()
+
+        self.server.modify(self.bob, uid='bob', sn='BB')
+        self.consumer.refresh()
+
+        self.assertEqual(self.server.cookies_received, [None, '3', '4'])
+        self.assertEqual(self.consumer.cookie, '5')
+        self.assertEqual(self.entries(),
+                         {'uid=ann,' + BASE : ['A'],
+                          'uid=bob,' + BASE : ['BB']})
+
+    def test_persist(self):
+        self.consumer.refresh()
+        self.consumer.persist()
+        try:
+            self.assertEqual(self.consumer.process(), True)
+            self.assertEqual(self.server.cookies_received, [None, '3'])
+
+            self.server.delete(self.ann)
+            self.server.add('uid=eve,' + BASE, uid='eve', sn='E')
+            self.assertEqual(self.consumer.process(), True)
+
+            self.assertEqual(self.consumer.cookie, '5')
+            self.assertEqual(self.entries(),
+                             {'uid=bob,' + BASE : ['B'],
+                              'uid=cid,' + BASE : ['C'],
+                              'uid=eve,' + BASE : ['E']})
+            self.assertEqual(self.consumer.stats()['persisting'], True)
+        finally:
+            self.consumer.stop()
+        self.assertEqual(self.consumer.stats()['persisting'], False)
+
+    def test_reload_without_result4_is_logged(self):
+        engine = StandInEngine(ReloadOnlyConnection(self.server))
+        consumer = SyncReplConsumer(StandInSearch(engine), BASE)
+
+        handler = ListHandler()
+        logger = logging.getLogger('ldapalchemy.syncrepl')
+        logger.addHandler(handler)
+        try:
+            consumer.refresh()
+            consumer.refresh()
+        finally:
+            logger.removeHandler(handler)
+
+        self.assertEqual(len(handler.records), 1)
+        self.assertEqual(consumer.stats()['mode'], 'reload')
+        self.assertEqual(len(consumer), 3)
+
+if __name__ == '__main__':
+    unittest.main()